@@ -0,0 +1,301 @@
+"""
+Benchmarks that drive `GitStorage` directly, without a FUSE mount.
+
+    python -m spaghettifs.benchmark.storage_bench [options] [NAME ...]
+    python -m spaghettifs.benchmark.storage_bench compare OLD.json NEW.json
+
+Each benchmark runs in its own process, on a fresh repository, and the
+results are printed (or saved with `-o`) as JSON. `compare` reads two
+such files and reports the metrics that got worse; it exits with status
+1 if any did.
+"""
+
+import sys
+import os
+from os import path
+import tempfile
+import shutil
+import time
+import random
+import resource
+import multiprocessing
+import json
+import logging
+from optparse import OptionParser
+
+from spaghettifs import easygit
+from spaghettifs import storage
+
+all_benchmarks = []
+
+def benchmark(setup=None):
+    """
+    Register a benchmark. It's called with a `GitStorage`, which doesn't
+    autocommit, and a `scale` factor, and returns the number of
+    operations and of bytes it processed. `setup`, if given, is called
+    the same way beforehand; its changes are committed, and the
+    repository is reopened, so the benchmark starts with cold caches.
+    """
+    def decorator(func):
+        func.setup = setup
+        all_benchmarks.append(func)
+        return func
+    return decorator
+
+def scaled(n, scale):
+    return max(1, int(n * scale))
+
+def write_file(f, size, chunk_size=64*1024):
+    for offset in xrange(0, size, chunk_size):
+        f.write_data(os.urandom(min(chunk_size, size - offset)), offset)
+
+LARGE_FILE = 32 * 1024 * 1024
+
+def make_large_file(repo, scale):
+    f = repo.get_root().create_file('large', size_hint=LARGE_FILE)
+    write_file(f, scaled(LARGE_FILE, scale))
+
+def make_small_files(repo, scale):
+    root = repo.get_root()
+    for c in xrange(scaled(200, scale)):
+        write_file(root.create_file('file-%d' % c), 256 * 1024)
+
+@benchmark()
+def small_files(repo, scale):
+    """ create small files and commit them """
+    root = repo.get_root()
+    count = scaled(2000, scale)
+    for c in xrange(count):
+        root.create_file('file-%d' % c).write_data(os.urandom(100), 0)
+    repo.commit('small files')
+    return count, count * 100
+
+@benchmark()
+def sequential_write(repo, scale):
+    """ write a large file in 64KB pieces, then commit """
+    f = repo.get_root().create_file('large')
+    size = scaled(LARGE_FILE, scale)
+    write_file(f, size)
+    repo.commit('sequential write')
+    return size / (64 * 1024), size
+
+@benchmark(setup=make_large_file)
+def random_write(repo, scale):
+    """ overwrite 4KB pieces at random offsets of a large file """
+    f = repo.get_root()['large']
+    rand = random.Random(0)
+    count = scaled(4096, scale)
+    for c in xrange(count):
+        offset = rand.randrange(f.size / 4096) * 4096
+        f.write_data(os.urandom(4096), offset)
+    repo.commit('random write')
+    return count, count * 4096
+
+@benchmark(setup=make_large_file)
+def sequential_read(repo, scale):
+    """ read a large file in 64KB pieces """
+    f = repo.get_root()['large']
+    size = f.size
+    for offset in xrange(0, size, 64 * 1024):
+        f.read_data(offset, 64 * 1024)
+    return size / (64 * 1024), size
+
+@benchmark(setup=make_large_file)
+def random_read(repo, scale):
+    """ read 4KB pieces at random offsets of a large file """
+    f = repo.get_root()['large']
+    rand = random.Random(0)
+    count = scaled(4096, scale)
+    for c in xrange(count):
+        f.read_data(rand.randrange(f.size / 4096) * 4096, 4096)
+    return count, count * 4096
+
+@benchmark()
+def big_directory(repo, scale):
+    """ fill a directory with empty files, then look each one up """
+    folder = repo.get_root().create_directory('big')
+    count = scaled(10000, scale)
+    for c in xrange(count):
+        folder.create_file('file-%d' % c)
+    repo.commit('big directory')
+    folder = repo.get_root()['big']
+    for c in xrange(count):
+        folder['file-%d' % c]
+    return 2 * count, 0
+
+@benchmark()
+def hardlinks(repo, scale):
+    """ make many hard links to one file """
+    root = repo.get_root()
+    f = root.create_file('original')
+    f.write_data(os.urandom(1000), 0)
+    count = scaled(2000, scale)
+    for c in xrange(count):
+        root.link_file('link-%d' % c, f)
+    repo.commit('hardlinks')
+    return count, 0
+
+@benchmark(setup=make_small_files)
+def truncate(repo, scale):
+    """ shrink files, then extend them again """
+    root = repo.get_root()
+    count = scaled(200, scale)
+    for c in xrange(count):
+        f = root['file-%d' % c]
+        f.truncate(1000 + c * 100)
+        f.truncate(128 * 1024)
+    repo.commit('truncate')
+    return 2 * count, 0
+
+@benchmark()
+def commits(repo, scale):
+    """ commit after each small change """
+    f = repo.get_root().create_file('counter')
+    count = scaled(200, scale)
+    for c in xrange(count):
+        f.write_data(str(c), 0)
+        repo.commit('change %d' % c)
+    return count, 0
+
+def run_benchmark(func, scale, file_layout):
+    temp_path = tempfile.mkdtemp()
+    try:
+        repo_path = path.join(temp_path, 'repo.sfs')
+        storage.GitStorage.create(repo_path, file_layout=file_layout)
+        if func.setup is not None:
+            repo = storage.GitStorage(repo_path, autocommit=False)
+            func.setup(repo, scale)
+            repo.commit('setup')
+            del repo
+            for cache in (easygit.blob_cache, easygit.tree_cache,
+                          storage.listing_cache):
+                cache.clear()
+
+        # like a mounted filesystem, benchmarks commit explicitly
+        repo = storage.GitStorage(repo_path, autocommit=False)
+        object_store = repo.eg.git.object_store
+        time0 = time.time()
+        ops, nbytes = func(repo, scale)
+        duration = time.time() - time0
+
+        return {
+            'time': duration,
+            'ops': ops,
+            'ops_per_sec': ops / duration,
+            'bytes_per_sec': nbytes / duration if nbytes else None,
+            'objects_written': object_store.objects_written,
+            # peak resident memory of the process, setup included
+            'peak_memory_kb':
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        shutil.rmtree(temp_path)
+
+def _run_in_child(func, scale, file_layout, queue):
+    try:
+        queue.put(run_benchmark(func, scale, file_layout))
+    except:
+        queue.put(None)
+        raise
+
+def run_all(names=None, scale=1.0, file_layout='blocks'):
+    """ Run benchmarks (all of them, unless `names` are given). """
+    results = {}
+    for func in all_benchmarks:
+        if names and func.func_name not in names:
+            continue
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_run_in_child,
+                                    args=(func, scale, file_layout, queue))
+        p.start()
+        result = queue.get()
+        p.join()
+        if result is None:
+            raise RuntimeError('benchmark %r failed' % func.func_name)
+        results[func.func_name] = result
+        print >> sys.stderr, '%s: %.2f ops/sec' % (
+            func.func_name, results[func.func_name]['ops_per_sec'])
+    return results
+
+# metric name, and whether a higher value is better
+compared_metrics = [('ops_per_sec', True), ('bytes_per_sec', True),
+                    ('objects_written', False), ('peak_memory_kb', False)]
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare two sets of results; return a list of ``(benchmark, metric,
+    old value, new value)`` for metrics that got worse by more than
+    `threshold` (a fraction of the old value).
+    """
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        for metric, higher_is_better in compared_metrics:
+            old_value = old[name].get(metric)
+            new_value = new[name].get(metric)
+            if not old_value or new_value is None:
+                continue
+            change = float(new_value - old_value) / old_value
+            if higher_is_better:
+                change = -change
+            if change > threshold:
+                regressions.append((name, metric, old_value, new_value))
+    return regressions
+
+usage = """\
+usage: %prog [options] [NAME ...]
+       %prog compare OLD.json NEW.json [--threshold FRACTION]
+""".strip()
+
+parser = OptionParser(usage=usage)
+parser.add_option("-o", "--output", dest="output",
+                  help="save results to this file instead of printing them")
+parser.add_option("--scale", type="float", dest="scale", default=1.0,
+                  help="multiply the size of each benchmark by this factor")
+parser.add_option("--chunked", action="store_const", const="chunked",
+                  dest="file_layout", default="blocks",
+                  help="use the chunked file layout")
+parser.add_option("--threshold", type="float", dest="threshold",
+                  default=0.1, help="fraction by which a metric may get "
+                                    "worse before it's reported (compare)")
+
+def main():
+    options, args = parser.parse_args()
+    handler = logging.StreamHandler()
+    handler.setLevel(logging.WARNING)
+    logging.getLogger('spaghettifs').addHandler(handler)
+
+    if args and args[0] == 'compare':
+        if len(args) != 3:
+            return parser.print_usage()
+        with open(args[1], 'rb') as f:
+            old = json.load(f)['benchmarks']
+        with open(args[2], 'rb') as f:
+            new = json.load(f)['benchmarks']
+        regressions = compare(old, new, options.threshold)
+        for name, metric, old_value, new_value in regressions:
+            print '%s: %s went from %.2f to %.2f' % (name, metric,
+                                                     old_value, new_value)
+        if regressions:
+            sys.exit(1)
+        print 'no regressions'
+        return
+
+    known = set(func.func_name for func in all_benchmarks)
+    for name in args:
+        if name not in known:
+            parser.error('unknown benchmark %r' % name)
+
+    report = {
+        'scale': options.scale,
+        'file_layout': options.file_layout,
+        'benchmarks': run_all(args, options.scale, options.file_layout),
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'wb') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
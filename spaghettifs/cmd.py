@@ -17,6 +17,25 @@ parser.add_option("-v", "--verbose",
                   action="store_const", const=logging.DEBUG, dest="loglevel")
 parser.add_option("-q", "--quiet",
                   action="store_const", const=logging.ERROR, dest="loglevel")
+parser.add_option("--block-size", type="int", dest="blocksize",
+                  help="default block size of files (mkfs)")
+parser.add_option("--chunked", action="store_const", const="chunked",
+                  dest="file_layout", default="blocks",
+                  help="split files at content-defined boundaries (mkfs)")
+parser.add_option("--attr-timeout", type="float", dest="attr_timeout",
+                  help="seconds the kernel may cache file attributes")
+parser.add_option("--entry-timeout", type="float", dest="entry_timeout",
+                  help="seconds the kernel may cache name lookups")
+parser.add_option("--kernel-cache", action="store_true", dest="kernel_cache",
+                  help="keep the kernel page cache when files are opened")
+parser.add_option("--no-auto-cache", action="store_false", dest="auto_cache",
+                  help="don't keep the page cache of unmodified files")
+parser.add_option("--checkpoint-ops", type="int", dest="max_operations",
+                  help="checkpoint after this many changes")
+parser.add_option("--checkpoint-bytes", type="int", dest="max_bytes",
+                  help="checkpoint after this many bytes are written")
+parser.add_option("--checkpoint-delay", type="float", dest="max_delay",
+                  help="checkpoint at most this many seconds after a change")
 parser.set_defaults(loglevel=logging.INFO)
 
 def main():
@@ -28,14 +47,27 @@ def main():
     elif args[0] == 'mkfs':
         if len(args) != 2:
             return parser.print_usage()
-        storage.GitStorage.create(args[1])
+        storage.GitStorage.create(args[1], default_blocksize=options.blocksize,
+                                  file_layout=options.file_layout)
 
     elif args[0] == 'mount':
         if len(args) != 3:
             return parser.print_usage()
         repo_path, mount_path = args[1:]
         print "mounting %r at %r" % (repo_path, mount_path)
-        filesystem.mount(repo_path, mount_path, loglevel=options.loglevel)
+        mount_options = {}
+        for name in ('attr_timeout', 'entry_timeout',
+                     'kernel_cache', 'auto_cache'):
+            value = getattr(options, name)
+            if value is not None:
+                mount_options[name] = value
+        checkpoint = {}
+        for name in ('max_operations', 'max_bytes', 'max_delay'):
+            value = getattr(options, name)
+            if value is not None:
+                checkpoint[name] = value
+        filesystem.mount(repo_path, mount_path, loglevel=options.loglevel,
+                         checkpoint=checkpoint, **mount_options)
 
     elif args[0] == 'fsck':
         if len(args) != 2:
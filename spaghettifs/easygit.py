@@ -1,13 +1,117 @@
 from time import time
+import os
 import weakref
 import logging
 import collections
+import threading
+import Queue
+import tempfile
+import binascii
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import dulwich
+from dulwich.file import GitFile
+from dulwich.object_store import DiskObjectStore
+from dulwich.pack import (Pack, SHA1Writer, write_pack_header,
+                          pack_object_header, write_pack_index_v2, iter_sha1)
 
 log = logging.getLogger('spaghettifs.easygit')
 log.setLevel(logging.DEBUG)
 
+class LRUCache(object):
+    """
+    LRU cache of git object contents, keyed by git id. Since git ids are
+    content addresses, entries never go stale. The size of a value is its
+    `len()` (bytes for blob data, entries for trees); oldest values are
+    evicted when the total size exceeds `max_size`.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, git_id):
+        with self._lock:
+            try:
+                data = self._data.pop(git_id)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[git_id] = data
+            self.hits += 1
+            return data
+
+    def __contains__(self, git_id):
+        return git_id in self._data
+
+    def pop(self, git_id):
+        with self._lock:
+            data = self._data.pop(git_id, None)
+            if data is not None:
+                self.size -= len(data)
+            return data
+
+    def put(self, git_id, data):
+        if len(data) > self.max_size:
+            return
+        with self._lock:
+            if git_id in self._data:
+                return
+            self._data[git_id] = data
+            self.size += len(data)
+            while self.size > self.max_size:
+                old_id, old_data = self._data.popitem(last=False)
+                self.size -= len(old_data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': self.size, 'count': len(self._data)}
+
+blob_cache = LRUCache(256 * 1024 * 1024) # 256 MB of blob data
+tree_cache = LRUCache(200 * 1000) # 200K tree entries
+
+pool_size = multiprocessing.cpu_count()
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+def parallel_map(func, items):
+    """
+    `map` over a pool of `pool_size` threads. It only pays off for
+    functions that release the GIL, like hashing and compression.
+    """
+    global _pool, _pool_pid
+    if len(items) < 2 or pool_size < 2:
+        return map(func, items)
+    with _pool_lock:
+        # a pool inherited through `fork` has no threads
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPool(pool_size)
+            _pool_pid = os.getpid()
+    return _pool.map(func, items)
+
+def fsync_path(path):
+    """ fsync a file, or a directory (to make renames in it durable). """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _hash_blob(git_blob):
+    return git_blob.id # computed once, then cached by dulwich
+
 class EasyTree(object):
     is_tree = True
 
@@ -20,8 +124,16 @@ class EasyTree(object):
             git_tree = dulwich.objects.Tree()
             self.git.object_store.add_object(git_tree)
             git_id = git_tree.id
-        log.debug('tree %r: loading git tree %r', self.name, git_id)
-        self._git_tree = self.git.tree(git_id)
+            tree_cache.put(git_id, git_tree)
+
+        # the git tree may be shared with other EasyTree objects, via
+        # `tree_cache`, so it must be copied before being modified
+        git_tree = tree_cache.get(git_id)
+        if git_tree is None:
+            log.debug('tree %r: loading git tree %r', self.name, git_id)
+            git_tree = self.git.tree(git_id)
+            tree_cache.put(git_id, git_tree)
+        self._git_tree = git_tree
         self._ctx_count = 0
         self._loaded = dict()
         self._dirty = dict()
@@ -74,41 +186,67 @@ class EasyTree(object):
         assert self._ctx_count > 0
         self._ctx_count -= 1
 
+    def _dirty_blobs(self):
+        for value in self._dirty.itervalues():
+            if isinstance(value, EasyTree):
+                for blob in value._dirty_blobs():
+                    yield blob
+            elif isinstance(value, EasyBlob) and value._git_id is None:
+                yield value
+
     def _commit(self):
+        # hash all new blobs in parallel first; the trees, which need the
+        # ids of their children, are then built bottom-up
+        new_blobs = [blob._git_blob for blob in self._dirty_blobs()]
+        if new_blobs:
+            log.debug('tree %r: hashing %d new blobs',
+                      self.name, len(new_blobs))
+            parallel_map(_hash_blob, new_blobs)
+        return self._build()
+
+    def _build(self):
         log.debug('tree %r: committing', self.name)
         assert self._ctx_count == 0
 
-        for name, value in self._dirty.iteritems():
-            if value is None:
-                log.debug('tree %r: removing entry %r', self.name, name)
-                if name in self._git_tree:
-                    del self._git_tree[name]
-                continue
-
-            value_git_id = value._commit()
-            if isinstance(value, EasyTree):
-                log.debug('tree %r: updating tree %r', self.name, name)
-                self._git_tree[name] = (040000, value_git_id)
-            elif isinstance(value, EasyBlob):
-                log.debug('tree %r: updating blob %r', self.name, name)
-                self._git_tree[name] = (0100644, value_git_id)
-            else:
-                assert False
-
-        self._dirty.clear()
-
-        self.git.object_store.add_object(self._git_tree)
+        if self._dirty:
+            git_tree = dulwich.objects.ShaFile.from_raw_string(
+                    self._git_tree.type_num, self._git_tree.as_raw_string())
+
+            for name, value in self._dirty.iteritems():
+                if value is None:
+                    log.debug('tree %r: removing entry %r', self.name, name)
+                    if name in git_tree:
+                        del git_tree[name]
+                    continue
+
+                if isinstance(value, EasyTree):
+                    log.debug('tree %r: updating tree %r', self.name, name)
+                    git_tree[name] = (040000, value._build())
+                elif isinstance(value, EasyBlob):
+                    log.debug('tree %r: updating blob %r', self.name, name)
+                    git_tree[name] = (0100644, value._commit())
+                else:
+                    assert False
+
+            self._dirty.clear()
+            if git_tree.id != self._git_tree.id:
+                self.git.object_store.add_object(git_tree)
+                tree_cache.put(git_tree.id, git_tree)
+            self._git_tree = git_tree
+
+        # a tree that didn't change is already in the object store
         git_id = self._git_tree.id
         log.debug('tree %r: finished commit, id=%r', self.name, git_id)
         return git_id
 
     def __getitem__(self, name):
-        if name in self._loaded:
-            value = self._loaded[name]()
+        ref = self._loaded.get(name)
+        if ref is not None:
+            value = ref()
             if value is None:
                 log.debug('tree %r: weakref to %r has expired',
                           self.name, name)
-                del self._loaded[name]
+                self._loaded.pop(name, None)
             else:
                 log.debug('tree %r: returning %r from cache',
                           self.name, name)
@@ -136,8 +274,7 @@ class EasyTree(object):
 
     def __delitem__(self, name):
         self._set_dirty(name, None)
-        if name in self._loaded:
-            del self._loaded[name]
+        self._loaded.pop(name, None)
 
     def __iter__(self):
         for name in self.keys():
@@ -155,14 +292,11 @@ class EasyTree(object):
     def remove(self):
         del self.parent[self.name]
 
-blob_cache = collections.deque(maxlen=10)
-
 class EasyBlob(object):
     is_tree = False
     _git_blob = None
 
     def __init__(self, git_repo, git_id=None, parent=None, name=None):
-        blob_cache.append(self)
         self.parent = parent
         self.name = name
         self.git = git_repo
@@ -173,6 +307,7 @@ class EasyBlob(object):
             git_id = git_blob.id
         log.debug('blob %r: loading git blob %r', self.name, git_id)
         self._git_id = git_id
+        self._stored_git_id = git_id # last version in the object store
         self._ctx_count = 0
 
     def __enter__(self):
@@ -184,18 +319,31 @@ class EasyBlob(object):
         self._ctx_count -= 1
 
     def _get_data(self):
-        if self._git_blob is None:
-            self._git_blob = self.git.get_blob(self._git_id)
-        return self._git_blob.data
+        git_id = self._git_id
+        if git_id is None:
+            return self._git_blob.data
+
+        data = blob_cache.get(git_id)
+        if data is None:
+            data = self.git.get_blob(git_id).data
+            blob_cache.put(git_id, data)
+        return data
 
     def _set_data(self, value):
         log.debug('blob %r: updating value', self.name)
-        self._git_id = None
+        # `_git_blob` is set first, for readers that see `_git_id` cleared
         self._git_blob = dulwich.objects.Blob.from_string(value)
+        self._git_id = None
         self.parent._set_dirty(self.name, self)
 
     data = property(_get_data, _set_data)
 
+    @property
+    def git_id(self):
+        if self._git_id is None:
+            return self._git_blob.id
+        return self._git_id
+
     def remove(self):
         del self.parent[self.name]
 
@@ -203,17 +351,296 @@ class EasyBlob(object):
         assert self._ctx_count == 0
 
         if self._git_id is None:
-            self.git.object_store.add_object(self._git_blob)
             self._git_id = self._git_blob.id
+            if self._git_id != self._stored_git_id:
+                self.git.object_store.add_object(self._git_blob)
+                self._stored_git_id = self._git_id
+            blob_cache.put(self._git_id, self._git_blob.data)
             del self._git_blob
             log.debug('blob %r: finished commit, id=%r',
                       self.name, self._git_id)
 
         return self._git_id
 
+class BlobPrefetcher(object):
+    """
+    Background thread that loads blobs into `blob_cache`, so that reading
+    them later is a cache hit. zlib releases the GIL, so decompression
+    overlaps with work done by the caller.
+    """
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def prefetch(self, blob):
+        if blob._git_id is None or blob._git_id in blob_cache:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='blob-prefetch')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put( (blob.git, blob._git_id) )
+
+    def wait(self):
+        """ Block until all queued blobs have been loaded. """
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            git, git_id = self._queue.get()
+            try:
+                if git_id not in blob_cache:
+                    blob_cache.put(git_id, git.get_blob(git_id).data)
+            except Exception:
+                log.exception('blob prefetch: failed to load %r', git_id)
+            finally:
+                self._queue.task_done()
+
+blob_prefetcher = BlobPrefetcher()
+
+class PackingObjectStore(object):
+    """
+    Wrapper over a dulwich object store that keeps new objects in memory
+    until `flush` is called, then writes them all out as a single packfile.
+    Objects are stored serialized, so readers always get a fresh copy.
+
+    Like git's `transfer.unpackLimit`, batches with fewer than
+    `min_pack_objects` objects, and under `min_pack_bytes` of data, are
+    written as loose objects instead, so that frequent tiny commits don't
+    litter the repository with packs. Like `git gc --auto`, once there
+    are more than `max_small_packs` packs under `small_pack_bytes`, they
+    are merged into one, so that lookups don't search ever more packs.
+
+    Objects are compressed in parallel, with `parallel_map`; since their
+    ids are already known, the pack index is written directly, instead
+    of being rebuilt by reading the pack back.
+
+    Reads come from many threads (FUSE, the `blob_prefetcher`), and
+    dulwich's packs read through a shared file object, so each thread
+    reads from its own copy of the underlying store; the lock only
+    guards the in-memory batches. Objects may be added, and read, while
+    `flush` writes out the previous batch; the batch stays readable from
+    memory until it's on disk. Merging packs removes the old ones, so a
+    read that fails meanwhile is retried on a fresh store.
+    """
+
+    min_pack_objects = 100
+    min_pack_bytes = 1024 * 1024
+    small_pack_bytes = 2 * 1024 * 1024
+    max_small_packs = 10
+
+    def __init__(self, object_store):
+        self.object_store = object_store
+        self._pending = {}
+        self._writing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self.objects_written = 0
+        # packs written by `flush`, for the readers of other threads
+        self._pack_paths = []
+        self._local = threading.local()
+        # held while merged packs are removed; counts the merges
+        self._merge_lock = threading.Lock()
+        self._merges = 0
+
+    def add_object(self, obj):
+        value = (obj.type_num, obj.as_raw_string())
+        with self._lock:
+            self._pending[obj.id] = value
+
+    def _reader(self):
+        """ Return this thread's copy of the underlying store. """
+        local = self._local
+        if getattr(local, 'merges', None) != self._merges:
+            if hasattr(local, 'store'):
+                local.store.close()
+            # a new store finds the packs already on disk when it loads
+            local.store = DiskObjectStore(self.object_store.path)
+            local.known_packs = len(self._pack_paths)
+            local.merges = self._merges
+        while local.known_packs < len(self._pack_paths):
+            local.store._add_known_pack(
+                    Pack(self._pack_paths[local.known_packs]))
+            local.known_packs += 1
+        return local.store
+
+    def __contains__(self, git_id):
+        with self._lock:
+            if git_id in self._pending or git_id in self._writing:
+                return True
+        return self._read(lambda store: git_id in store)
+
+    def __getitem__(self, git_id):
+        with self._lock:
+            value = self._pending.get(git_id) or self._writing.get(git_id)
+        if value is not None:
+            type_num, raw = value
+            return dulwich.objects.ShaFile.from_raw_string(type_num, raw)
+        return self._read(lambda store: store[git_id])
+
+    def _read(self, read):
+        """ Call `read` with this thread's store. """
+        try:
+            return read(self._reader())
+        except (IOError, OSError):
+            # a merge may have removed packs that the store knew of; once
+            # it's done, `_reader` loads a fresh store
+            with self._merge_lock:
+                pass
+            return read(self._reader())
+
+    def __getattr__(self, name):
+        return getattr(self.object_store, name)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                self._writing, self._pending = self._pending, {}
+            new_objects = self._writing.items()
+            nbytes = sum(len(raw) for git_id, (type_num, raw) in new_objects)
+            if (len(new_objects) < self.min_pack_objects and
+                    nbytes < self.min_pack_bytes):
+                log.debug('easygit repo: writing %d loose objects',
+                          len(new_objects))
+                compressed = parallel_map(_compress_loose, new_objects)
+                dirs = set()
+                for (git_id, value), data in zip(new_objects, compressed):
+                    dirs.update(self._write_loose(git_id, data))
+                for dir_path in sorted(dirs, reverse=True):
+                    fsync_path(dir_path)
+                with self._lock:
+                    self._writing = {}
+            else:
+                log.debug('easygit repo: writing pack with %d objects',
+                          len(new_objects))
+                records = parallel_map(_compress_packed, new_objects)
+                pack_path = self._write_pack(
+                        [git_id for git_id, value in new_objects], records)
+                with self._lock:
+                    self.object_store._add_known_pack(Pack(pack_path))
+                    self._pack_paths.append(pack_path)
+                    self._writing = {}
+                self._merge_small_packs()
+            self.objects_written += len(new_objects)
+
+    def _merge_small_packs(self):
+        """
+        Once there are more than `max_small_packs` packs smaller than
+        `small_pack_bytes`, rewrite their objects as a single pack, and
+        remove them.
+        """
+        pack_dir = self.object_store.pack_dir
+        small_packs = []
+        for name in sorted(os.listdir(pack_dir)):
+            if not (name.startswith('pack-') and name.endswith('.pack')):
+                continue
+            path = os.path.join(pack_dir, name)
+            if os.path.getsize(path) < self.small_pack_bytes:
+                small_packs.append(path[:-len('.pack')])
+        if len(small_packs) <= self.max_small_packs:
+            return
+
+        log.debug('easygit repo: merging %d small packs', len(small_packs))
+        objects = {}
+        for base_path in small_packs:
+            pack = Pack(base_path)
+            try:
+                for git_id in pack:
+                    obj = pack[git_id]
+                    objects[git_id] = (obj.type_num, obj.as_raw_string())
+            finally:
+                pack.close()
+        new_objects = objects.items()
+        records = parallel_map(_compress_packed, new_objects)
+        merged_path = self._write_pack(
+                [git_id for git_id, value in new_objects], records)
+
+        with self._merge_lock:
+            with self._lock:
+                self._merges += 1
+                self._pack_paths = []
+                self.object_store.close()
+            for base_path in small_packs:
+                if base_path == merged_path:
+                    continue
+                os.remove(base_path + '.pack')
+                os.remove(base_path + '.idx')
+            fsync_path(pack_dir)
+
+    def _write_loose(self, git_id, data):
+        """
+        Write a loose object, and fsync it; return the directories that
+        must be fsynced for it to be found after a crash.
+        """
+        dirs = []
+        dir_path = os.path.join(self.object_store.path, git_id[:2])
+        if not os.path.isdir(dir_path):
+            os.mkdir(dir_path)
+            dirs.append(self.object_store.path)
+        path = os.path.join(dir_path, git_id[2:])
+        if os.path.exists(path):
+            return dirs
+        f = GitFile(path, 'wb')
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        dirs.append(dir_path)
+        return dirs
+
+    def _write_pack(self, git_ids, records):
+        pack_dir = self.object_store.pack_dir
+        fd, temp_path = tempfile.mkstemp(dir=pack_dir, suffix='.pack')
+        entries = []
+        with os.fdopen(fd, 'wb') as f:
+            writer = SHA1Writer(f)
+            write_pack_header(writer, len(records))
+            for git_id, (record, crc32) in zip(git_ids, records):
+                entries.append((binascii.a2b_hex(git_id),
+                                writer.offset(), crc32))
+                writer.write(record)
+            pack_checksum = writer.write_sha()
+            f.flush()
+            os.fsync(fd)
+
+        entries.sort()
+        base_path = os.path.join(pack_dir, 'pack-%s' %
+                                 iter_sha1(entry[0] for entry in entries))
+        f = GitFile(base_path + '.idx', 'wb')
+        try:
+            write_pack_index_v2(f, entries, pack_checksum)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp_path, base_path + '.pack')
+        fsync_path(pack_dir)
+        return base_path
+
+def _compress_loose(item):
+    git_id, (type_num, raw) = item
+    compressor = zlib.compressobj()
+    header = dulwich.objects.object_header(type_num, len(raw))
+    return (compressor.compress(header) + compressor.compress(raw) +
+            compressor.flush())
+
+def _compress_packed(item):
+    """ Return the pack record of an object, and its crc32. """
+    git_id, (type_num, raw) = item
+    record = pack_object_header(type_num, None, len(raw)) + zlib.compress(raw)
+    return record, zlib.crc32(record) & 0xffffffff
+
 class EasyGit(object):
     def __init__(self, git_repo):
         self.git = git_repo
+        if not isinstance(git_repo.object_store, PackingObjectStore):
+            git_repo.object_store = PackingObjectStore(git_repo.object_store)
         try:
             git_commit_id = self.git.head()
         except:
@@ -226,11 +653,22 @@ class EasyGit(object):
 
     def commit(self, author, message, parents=[], branch='master'):
         log.debug('easygit repo: starting commit')
+        self.write_commit(self.snapshot(), author, message, parents, branch)
+
+    def snapshot(self):
+        """
+        Serialize the changed trees and blobs; return the id of the root
+        tree. The new objects are kept in memory until `write_commit`, and
+        the tree can be changed again in the meantime.
+        """
+        return self.root._commit()
+
+    def write_commit(self, root_git_id, author, message, parents=[],
+                     branch='master'):
+        """ Write out pending objects, and a commit of `root_git_id`. """
         for parent_id in parents:
             assert self.git.commit(parent_id)
 
-        root_git_id = self.root._commit()
-
         commit_time = int(time())
 
         git_commit = dulwich.objects.Commit()
@@ -246,7 +684,14 @@ class EasyGit(object):
         git_commit.parents = parents
 
         self.git.object_store.add_object(git_commit)
-        self.git.refs['refs/heads/%s' % branch] = git_commit.id
+        self.git.object_store.flush()
+        ref_name = 'refs/heads/%s' % branch
+        self.git.refs[ref_name] = git_commit.id
+        # the commit is durable once this returns; objects were fsynced
+        # by `flush`
+        ref_path = self.git.refs.refpath(ref_name)
+        fsync_path(ref_path)
+        fsync_path(os.path.dirname(ref_path))
         log.debug('easygit repo: finished commit, id=%r', git_commit.id)
 
     def get_head_id(self, name="master"):
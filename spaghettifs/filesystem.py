@@ -1,164 +1,474 @@
 import os
-from errno import ENOENT, EPERM
+from errno import ENOENT, EPERM, EISDIR
 from stat import S_IFDIR, S_IFREG
 from time import time
 import logging
 from datetime import datetime
 import threading
-import functools
 import collections
+import itertools
+from contextlib import contextmanager
 
 from fuse import FUSE, Operations
-from storage import GitStorage
+from storage import GitStorage, CommitPolicy
+from journal import Journal, read_journal
 
 log = logging.getLogger('spaghettifs.filesystem')
 log.setLevel(logging.DEBUG)
 
 WRITE_BUFFER_SIZE = 3 * 1024 * 1024 # 3MB
 
-def memoize(size):
-    memo = collections.deque(maxlen=size)
+# when a mounted filesystem is checkpointed; see `CommitPolicy`
+default_checkpoint_policy = {
+    'max_operations': 1000,
+    'max_bytes': WRITE_BUFFER_SIZE,
+    'max_delay': 10.0,
+}
+
+# journal of operations since the last commit, in the repository folder
+JOURNAL_FILE = 'spaghettifs.journal'
+
+# passed on to FUSE as mount options; timeouts are in seconds
+default_mount_options = {
+    'attr_timeout': 1.0,
+    'entry_timeout': 1.0,
+    'kernel_cache': False,
+    'auto_cache': True,
+}
+
+# directories have no inode, so their `st_ino` is handed out by the mount
+# (folders can't be renamed), above the range used by file inode numbers
+DIR_INO_BASE = 1 << 32
+
+class RWLock(object):
+    """
+    Lock that is held either by any number of readers or by one writer.
+    Waiting writers keep new readers out, so they are not starved. It is
+    not reentrant.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class DentryCache(object):
+    """
+    LRU cache that maps paths to storage objects (`StorageDir` or
+    `StorageFile`). A value of `None` is a negative entry, for a path that
+    does not exist.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
 
-    def decorator(f):
-        @functools.wraps(f)
-        def wrapper(*args):
-            for key, value in memo:
-                if key == args:
-                    break
-            else:
-                value = f(*args)
-                memo.append( (args, value) )
+    def lookup(self, path):
+        """ Return the cached object; raise KeyError if not cached. """
+        with self._lock:
+            try:
+                obj = self._entries.pop(path)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._entries[path] = obj
+            self.hits += 1
+            return obj
+
+    def store(self, path, obj):
+        with self._lock:
+            self._entries.pop(path, None)
+            self._entries[path] = obj
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, path, recursive=False):
+        """ Forget `path` and, if `recursive`, everything below it. """
+        with self._lock:
+            self._entries.pop(path, None)
+            if recursive:
+                prefix = path.rstrip('/') + '/'
+                for cached_path in list(self._entries):
+                    if cached_path.startswith(prefix):
+                        del self._entries[cached_path]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'count': len(self._entries)}
+
+class Checkpointer(threading.Thread):
+    """
+    Background thread that amends the "mounted" commit of a `SpaghettiFS`
+    when `policy`, a `CommitPolicy`, says so. Changes are counted with
+    `record`; the delay limit is checked every `poll_interval` seconds.
+    """
+
+    poll_interval = 1.0
+
+    def __init__(self, fs, policy):
+        super(Checkpointer, self).__init__(name='spaghettifs checkpointer')
+        self.daemon = True
+        self.fs = fs
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+
+    def record(self, operations=0, nbytes=0):
+        with self._lock:
+            self.policy.record(operations, nbytes)
+            due = self.policy.should_commit()
+        if due:
+            self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            if self._stopped:
+                return
+            with self._lock:
+                due = self.policy.should_commit()
+                if due:
+                    # changes made during the commit count for the next one
+                    self.policy.reset()
+            if due:
+                try:
+                    self.fs.commit_mounted()
+                except Exception:
+                    log.exception('Checkpoint failed')
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+        self.join()
 
-            return value
+class SpaghettiFS(Operations):
+    """
+    FUSE operations on a `GitStorage` (with autocommit turned off).
 
-        wrapper.flush_memo = memo.clear
-        return wrapper
+    FUSE calls these from several threads. Every call holds `_global_lock`
+    for reading, and commits hold it for writing, so a commit sees a quiet
+    tree. Lookups hold `_namespace_lock` for reading and changes to the
+    directory structure hold it for writing. File data and metadata are
+    guarded by the inode's own `lock`, so I/O on different files runs in
+    parallel.
 
-    return decorator
+    If `journal` is set, every change is recorded there while the locks
+    that order it are held: namespace changes by path, file data by
+    inode name. Replaying the records on the same tree, with
+    `replay_journal`, gives the same inode names, so the two agree.
+
+    If `checkpointer` is set, changes are reported to it, and it commits
+    them in the background.
+    """
+
+    dentry_cache_size = 4096
+
+    # operations that are reported to `checkpointer`
+    changing_ops = frozenset(['create', 'link', 'mkdir', 'rename', 'rmdir',
+                              'truncate', 'unlink', 'write'])
 
-class SpaghettiFS(Operations):
     def __init__(self, repo):
         self.repo = repo
-        self._write_count = 0
-        # the FUSE library seems to assume we're thread-safe, so we use a
-        # big fat lock, just in case
-        self._lock = threading.Lock()
+        self.dentries = DentryCache(self.dentry_cache_size)
+        # open file handles: fh number -> StorageInode
+        self._handles = {}
+        self._fh_counter = itertools.count(1)
+        self._global_lock = RWLock()
+        self._namespace_lock = RWLock()
+        # directories have no timestamps of their own
+        self._mount_time = int(time())
+        # directory path -> st_ino, kept for as long as we're mounted
+        self._dir_inos = {}
+        self._dir_ino_counter = itertools.count(DIR_INO_BASE)
+        self.journal = None
+        self.checkpointer = None
+        self._commit_lock = threading.Lock()
+
+    def _log(self, *record):
+        if self.journal is not None:
+            self.journal.append(*record)
+
+    def replay_journal(self, records):
+        """ Redo the operations of journal `records`. """
+        for record in records:
+            op, args = record[0], record[1:]
+            try:
+                if op == 'write':
+                    name, offset, data = args
+                    self.repo.get_inode(name).write_data(data, offset)
+                elif op == 'truncate':
+                    name, length = args
+                    self.repo.get_inode(name).truncate(length)
+                elif op == 'create':
+                    self.release(args[0], self.create(*args))
+                else:
+                    getattr(self, op)(*args)
+            except Exception:
+                log.exception('Failed to replay journaled %r of %r',
+                              op, args[0])
+
+    def commit_mounted(self, message=None):
+        """
+        Amend the "mounted" commit. Operations are held off only while
+        the changes are snapshotted; objects are written without locks.
+        """
+        with self._commit_lock:
+            with self._global_lock.write():
+                tree_id = self.repo.snapshot()
+                if self.journal is not None:
+                    segment = self.journal.start(tree_id)
+            self.repo.write_commit(tree_id, message, amend=True,
+                                   branch="mounted")
+            # the commit is on disk, fsynced, so the journal can go
+            if self.journal is not None:
+                self.journal.discard(segment)
 
-    @memoize(10)
     def get_obj(self, path):
-        #assert(path.startswith('/'))
-        obj = self.repo.get_root()
-        for frag in path[1:].split('/'):
-            if frag == '':
-                continue
-            try:
-                obj = obj[frag]
-            except KeyError:
-                return None
+        path = path.rstrip('/') or '/'
+        try:
+            return self.dentries.lookup(path)
+        except KeyError:
+            pass
 
+        if path == '/':
+            obj = self.repo.get_root()
+        else:
+            parent_path, name = os.path.split(path)
+            parent = self.get_obj(parent_path)
+            obj = None
+            if parent is not None and parent.is_dir:
+                try:
+                    obj = parent[name]
+                except KeyError:
+                    if name in parent:
+                        # a broken entry, not a missing one; don't cache
+                        log.exception('Failed to look up %r', path)
+                        return None
+
+        self.dentries.store(path, obj)
         return obj
 
+    def _open_handle(self, obj):
+        fh = next(self._fh_counter)
+        self._handles[fh] = obj.inode
+        return fh
+
+    def _get_inode(self, path, fh):
+        """
+        Return the inode of an open file handle, falling back to a path
+        lookup if there is no such handle (e.g. `truncate` without `fh`).
+        """
+        inode = self._handles.get(fh)
+        if inode is None:
+            with self._namespace_lock.read():
+                obj = self.get_obj(path)
+            if obj is None or obj.is_dir:
+                return None
+            inode = obj.inode
+        return inode
+
+    def _dir_ino(self, path):
+        try:
+            return self._dir_inos[path]
+        except KeyError:
+            # readers may race here; `setdefault` keeps a single winner
+            return self._dir_inos.setdefault(path,
+                                             next(self._dir_ino_counter))
+
     def getattr(self, path, fh=None):
-        obj = self.get_obj(path)
+        with self._namespace_lock.read():
+            obj = self.get_obj(path)
         if obj is None:
             raise OSError(ENOENT, '')
 
         if obj.is_dir:
             st = dict(st_mode=(S_IFDIR | 0755), st_nlink=2)
+            st['st_ino'] = self._dir_ino(obj.path)
+            st['st_ctime'] = st['st_mtime'] = self._mount_time
         else:
-            st = dict(st_mode=(S_IFREG | 0444), st_size=obj.size)
-            st['st_nlink'] = obj.inode['nlink']
-
-            # FUSE seeems to ignore our st_ino
-            #st['st_ino'] = int(obj.inode.name[1:])
-
-        st['st_ctime'] = st['st_mtime'] = st['st_atime'] = time()
+            inode = obj.inode
+            with inode.lock:
+                st = dict(st_mode=(S_IFREG | 0444), st_size=inode['size'])
+                st['st_nlink'] = inode['nlink']
+                st['st_ino'] = int(inode.name[1:])
+                st['st_mtime'] = inode['mtime']
+                st['st_ctime'] = inode['ctime']
+
+        st['st_atime'] = st['st_mtime']
         return st
 
     def create(self, path, mode):
         parent_path, file_name = os.path.split(path)
-        parent = self.get_obj(parent_path)
-        parent.create_file(file_name)
-        self.get_obj.flush_memo()
-        return 0
+        with self._namespace_lock.write():
+            parent = self.get_obj(parent_path)
+            obj = parent.create_file(file_name)
+            self.dentries.invalidate(path)
+            self._log('create', path, mode)
+        return self._open_handle(obj)
 
     def link(self, target, source):
-        source_obj = self.get_obj(source)
-        target_parent_obj = self.get_obj(os.path.dirname(target))
-        target_parent_obj.link_file(os.path.basename(target), source_obj)
-        self.get_obj.flush_memo()
+        with self._namespace_lock.write():
+            source_obj = self.get_obj(source)
+            target_parent_obj = self.get_obj(os.path.dirname(target))
+            with source_obj.inode.lock:
+                target_parent_obj.link_file(os.path.basename(target),
+                                            source_obj)
+            self.dentries.invalidate(target)
+            self._log('link', target, source)
 
     def mkdir(self, path, mode):
         parent_path, dir_name = os.path.split(path)
-        parent = self.get_obj(parent_path)
-        parent.create_directory(dir_name)
-        self.get_obj.flush_memo()
+        with self._namespace_lock.write():
+            parent = self.get_obj(parent_path)
+            parent.create_directory(dir_name)
+            self.dentries.invalidate(path)
+            self._log('mkdir', path, mode)
+
+    def open(self, path, flags):
+        with self._namespace_lock.read():
+            obj = self.get_obj(path)
+        if obj is None:
+            raise OSError(ENOENT, '')
+        if obj.is_dir:
+            raise OSError(EISDIR, '')
+        return self._open_handle(obj)
 
     def read(self, path, size, offset, fh):
-        obj = self.get_obj(path)
-        if obj is None or obj.is_dir:
+        inode = self._get_inode(path, fh)
+        if inode is None:
             return ''
         else:
-            return obj.read_data(offset, size)
+            with inode.lock:
+                return inode.read_data(offset, size)
 
     def readdir(self, path, fh):
-        obj = self.get_obj(path)
-        return ['.', '..'] + list(obj.keys())
+        with self._namespace_lock.read():
+            obj = self.get_obj(path)
+            return ['.', '..'] + list(obj.keys())
 
     def rename(self, source, target):
-        source_obj = self.get_obj(source)
-        if source_obj.is_dir:
-            raise OSError(EPERM, '')
-        target_parent_obj = self.get_obj(os.path.dirname(target))
-        target_parent_obj.link_file(os.path.basename(target), source_obj)
-        source_obj.unlink()
-        self.get_obj.flush_memo()
+        with self._namespace_lock.write():
+            source_obj = self.get_obj(source)
+            if source_obj.is_dir:
+                raise OSError(EPERM, '')
+            target_parent_obj = self.get_obj(os.path.dirname(target))
+            with source_obj.inode.lock:
+                target_parent_obj.link_file(os.path.basename(target),
+                                            source_obj)
+                source_obj.unlink()
+            self.dentries.invalidate(source)
+            self.dentries.invalidate(target)
+            self._log('rename', source, target)
 
     def rmdir(self, path):
-        obj = self.get_obj(path)
-        if obj is None or not obj.is_dir:
-            return
+        with self._namespace_lock.write():
+            obj = self.get_obj(path)
+            if obj is None or not obj.is_dir:
+                return
 
-        obj.unlink()
-        self.get_obj.flush_memo()
+            obj.unlink()
+            self.dentries.invalidate(path, recursive=True)
+            self._log('rmdir', path)
 
     def truncate(self, path, length, fh=None):
-        obj = self.get_obj(path)
-        if obj is None or obj.is_dir:
+        inode = self._get_inode(path, fh)
+        if inode is None:
             return
 
-        obj.truncate(length)
+        with inode.lock:
+            inode.truncate(length)
+            self._log('truncate', inode.name, length)
 
     def unlink(self, path):
-        obj = self.get_obj(path)
-        if obj is None or obj.is_dir:
-            return
+        with self._namespace_lock.write():
+            obj = self.get_obj(path)
+            if obj is None or obj.is_dir:
+                return
 
-        obj.unlink()
-        self.get_obj.flush_memo()
+            with obj.inode.lock:
+                obj.unlink()
+            self.dentries.invalidate(path)
+            self._log('unlink', path)
 
     def write(self, path, data, offset, fh):
-        obj = self.get_obj(path)
-        if obj is None or obj.is_dir:
+        inode = self._get_inode(path, fh)
+        if inode is None:
             return 0
 
-        obj.write_data(data, offset)
-
-        if not self.repo.autocommit:
-            self._write_count += len(data)
-            if self._write_count > WRITE_BUFFER_SIZE:
-                self.repo.commit(amend=True, branch="mounted")
-                self._write_count = 0
+        with inode.lock:
+            inode.write_data(data, offset)
+            self._log('write', inode.name, offset, data)
 
         return len(data)
 
+    def flush(self, path, fh):
+        inode = self._get_inode(path, fh)
+        if inode is not None:
+            inode.flush()
+        return 0
+
+    def fsync(self, path, datasync, fh):
+        # the journal makes changes durable; committing waits for later
+        if self.journal is not None:
+            self.journal.sync()
+        return 0
+
+    def release(self, path, fh):
+        self.flush(path, fh)
+        self._handles.pop(fh, None)
+        return 0
+
 #    access = None
-    flush = None
     getxattr = None
     listxattr = None
-    open = None
     opendir = None
-    release = None
     releasedir = None
     statfs = None
 
@@ -166,15 +476,17 @@ class SpaghettiFS(Operations):
         log.debug('FUSE api call: %r %r %r',
                   op, path, tuple(LogWrap(arg) for arg in args))
         ret = '[Unknown Error]'
-        self._lock.acquire()
         try:
-            ret = super(SpaghettiFS, self).__call__(op, path, *args)
+            with self._global_lock.read():
+                ret = super(SpaghettiFS, self).__call__(op, path, *args)
+            if self.checkpointer is not None and op in self.changing_ops:
+                nbytes = len(args[0]) if op == 'write' else 0
+                self.checkpointer.record(1, nbytes)
             return ret
         except OSError, e:
             ret = str(e)
             raise
         finally:
-            self._lock.release()
             log.debug('FUSE api return: %r %r', op, LogWrap(ret))
 
 class LogWrap(object):
@@ -194,9 +506,16 @@ class LogWrap(object):
 datefmt = lambda dt: dt.strftime('%Y-%m-%d %H:%M:%S')
 
 class _open_fs(object):
-    def __init__(self, repo_path, cls):
+    """
+    Open the filesystem for mounting, on a "mounted" branch, recovering
+    from a previous session that didn't end cleanly. If a `checkpoint`
+    policy is given, a `Checkpointer` commits changes as they are made.
+    """
+
+    def __init__(self, repo_path, cls, checkpoint=None):
         self.repo_path = repo_path
         self.cls = cls
+        self.checkpoint = checkpoint
 
     def __enter__(self):
         self.time_mount = datetime.now()
@@ -204,6 +523,16 @@ class _open_fs(object):
         self.repo = GitStorage(self.repo_path, autocommit=False)
         self.git = self.repo.eg.git
 
+        if 'refs/heads/mounted' in self.git.refs:
+            # the last session ended without unmounting; keep what it
+            # committed, then redo its journal on top
+            log.warning('Filesystem was not unmounted cleanly, recovering')
+            mounted_id = self.git.refs['refs/heads/mounted']
+            self.git.refs['refs/heads/master'] = mounted_id
+            del self.git.refs['refs/heads/mounted']
+            self.repo = GitStorage(self.repo_path, autocommit=False)
+            self.git = self.repo.eg.git
+
         master_id = self.git.refs['refs/heads/master']
         self.initial_tree_id = self.git.commit(master_id).tree
 
@@ -211,14 +540,29 @@ class _open_fs(object):
                datefmt(self.time_mount))
         self.repo.commit(msg, branch="mounted", head_id=master_id)
 
-        return self.cls(self.repo)
+        self.fs = self.cls(self.repo)
+        self.journal_path = os.path.join(self.repo_path, JOURNAL_FILE)
+        records = read_journal(self.journal_path, self.initial_tree_id)
+        if records:
+            log.warning('Replaying %d journaled operations', len(records))
+            self.fs.replay_journal(records)
+        self.fs.journal = Journal(self.journal_path)
+        self.fs.commit_mounted()
+
+        if self.checkpoint is not None:
+            self.fs.checkpointer = Checkpointer(self.fs, self.checkpoint)
+            self.fs.checkpointer.start()
+
+        return self.fs
 
     def __exit__(self, e0, e1, e2):
+        if self.fs.checkpointer is not None:
+            self.fs.checkpointer.stop()
         self.time_unmount = datetime.now()
 
         msg = ("Mounted operations:\n  mounted at %s\n  unmounted at %s\n" %
                (datefmt(self.time_mount), datefmt(self.time_unmount)))
-        self.repo.commit(msg, amend=True, branch="mounted")
+        self.fs.commit_mounted(msg)
 
         mounted_id = self.git.refs['refs/heads/mounted']
         mounted_tree_id = self.git.commit(mounted_id).tree
@@ -228,11 +572,30 @@ class _open_fs(object):
 
         del self.git.refs['refs/heads/mounted']
 
-def mount(repo_path, mount_path, cls=SpaghettiFS, loglevel=logging.ERROR):
+        self.fs.journal.remove()
+
+def mount(repo_path, mount_path, cls=SpaghettiFS, loglevel=logging.ERROR,
+          checkpoint=None, **options):
+    """
+    Mount the filesystem. `checkpoint` overrides limits of
+    `default_checkpoint_policy`. Other keyword arguments override
+    `default_mount_options`; options set to `False` or `None` are left out.
+    """
     if loglevel is not None:
         stderr_handler = logging.StreamHandler()
         stderr_handler.setLevel(loglevel)
         logging.getLogger('spaghettifs').addHandler(stderr_handler)
 
-    with _open_fs(repo_path, cls) as fs:
-        FUSE(fs, mount_path, foreground=True)
+    fuse_options = {}
+    for name, value in dict(default_mount_options, **options).iteritems():
+        if value is True:
+            fuse_options[name] = True
+        elif value is not False and value is not None:
+            # FUSE turns anything that compares equal to True (like a
+            # timeout of 1.0) into a flag, so pass values as strings
+            fuse_options[name] = str(value)
+
+    policy = CommitPolicy(**dict(default_checkpoint_policy,
+                                 **(checkpoint or {})))
+    with _open_fs(repo_path, cls, policy) as fs:
+        FUSE(fs, mount_path, foreground=True, use_ino=True, **fuse_options)
@@ -0,0 +1,163 @@
+"""
+Write-ahead journal of a mounted filesystem. Operations are appended to a
+file as they happen, so whatever was done since the last commit can be
+replayed after a crash.
+
+The journal is a series of numbered segment files, ``<path>.<n>``. Each
+segment starts with a ``('base', tree_id)`` record, for the root tree
+that its operations apply to, and a new segment is started whenever a
+commit is snapshotted; the older ones are removed once the commit is
+written. Segments after the one whose base matches the committed tree
+are replayed in order.
+
+Records are tuples of strings and integers, serialized with `marshal`
+(the journal only has to be read back by the same installation) and
+framed by their length and crc32, so a record that was only partially
+written when the process died is recognized, and ignored, along with
+everything after it.
+"""
+
+import os
+from time import time
+import logging
+import threading
+import struct
+import marshal
+import zlib
+
+log = logging.getLogger('spaghettifs.journal')
+log.setLevel(logging.DEBUG)
+
+record_header = struct.Struct('<II') # payload length, crc32 of payload
+
+def _frame(record):
+    payload = marshal.dumps(record)
+    crc = zlib.crc32(payload) & 0xffffffff
+    return record_header.pack(len(payload), crc) + payload
+
+def _write(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def segment_path(path, number):
+    return '%s.%d' % (path, number)
+
+def segment_numbers(path):
+    """ Return the numbers of the segments of journal `path`, sorted. """
+    folder, prefix = os.path.split(path)
+    numbers = []
+    for name in os.listdir(folder or '.'):
+        if name.startswith(prefix + '.'):
+            suffix = name[len(prefix) + 1:]
+            if suffix.isdigit():
+                numbers.append(int(suffix))
+    return sorted(numbers)
+
+class Journal(object):
+    """
+    Appends records to the current segment of journal `path`, with
+    `os.write`, so they survive the process crashing. Surviving a system
+    crash needs `fsync`, which is batched: `append` calls it at most once
+    every `sync_interval` seconds, and `sync` forces it.
+    """
+
+    sync_interval = 1.0
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._fd = None
+        self._number = (segment_numbers(path) or [0])[-1]
+        self._unsynced = False
+        self._last_sync = time()
+
+    def start(self, base):
+        """
+        Start a new segment, for changes to root tree `base`; return its
+        number, for `discard`.
+        """
+        with self._lock:
+            number = self._number + 1
+            fd = os.open(segment_path(self.path, number),
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_APPEND,
+                         0644)
+            _write(fd, _frame(('base', base)))
+            os.fsync(fd)
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+            self._fd, self._number = fd, number
+            self._unsynced = False
+            self._last_sync = time()
+        return number
+
+    def discard(self, number):
+        """ Remove the segments before `number`; they were committed. """
+        for n in segment_numbers(self.path):
+            if n < number:
+                os.remove(segment_path(self.path, n))
+
+    def append(self, *record):
+        data = _frame(record)
+        with self._lock:
+            _write(self._fd, data)
+            self._unsynced = True
+            sync_due = time() - self._last_sync >= self.sync_interval
+        if sync_due:
+            self.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._unsynced:
+                os.fsync(self._fd)
+                self._unsynced = False
+                self._last_sync = time()
+
+    def remove(self):
+        """ Close the journal, and remove it, along with older segments. """
+        with self._lock:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        self.discard(self._number + 1)
+
+def _read_segment(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    records = []
+    offset = 0
+    while offset < len(data):
+        if offset + record_header.size > len(data):
+            break
+        length, crc = record_header.unpack_from(data, offset)
+        payload = data[offset + record_header.size:
+                       offset + record_header.size + length]
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        records.append(marshal.loads(payload))
+        offset += record_header.size + length
+
+    if offset < len(data):
+        log.warning('Ignoring %d bytes of incomplete records at the end of '
+                    'journal segment %r', len(data) - offset, path)
+
+    if not records or records[0][0] != 'base':
+        return None, []
+    return records[0][1], records[1:]
+
+def read_journal(path, base):
+    """
+    Return the records of journal `path` that were not committed, given
+    that the last commit has root tree `base`.
+    """
+    records = []
+    found = False
+    for number in segment_numbers(path):
+        segment_base, segment_records = _read_segment(
+                segment_path(path, number))
+        if segment_base == base:
+            found = True
+        if found:
+            records.extend(segment_records)
+    return records
@@ -8,8 +8,16 @@ from itertools import chain
 import weakref
 import json
 import functools
-
-from easygit import EasyGit
+import collections
+import hashlib
+import array
+import multiprocessing
+import threading
+import struct
+import bisect
+from contextlib import contextmanager
+
+from easygit import EasyGit, LRUCache, blob_prefetcher
 from treetree import TreeTree
 
 log = logging.getLogger('spaghettifs.storage')
@@ -45,11 +53,67 @@ class FeatureBlob(object):
         data[key] = value
         self.save(data)
 
+class CommitPolicy(object):
+    """
+    Decides when a `GitStorage` in autocommit mode should commit. Changes
+    are grouped into one commit until `max_operations` operations,
+    `max_bytes` bytes written, or `max_delay` seconds since the first
+    uncommitted change is reached, whichever comes first. Limits set to
+    `None` are ignored.
+
+    `GitStorage` only checks the limits when an operation completes, so
+    `max_delay` is not a time bound: changes made before the storage goes
+    idle stay uncommitted until the next operation. Embedders must call
+    `GitStorage.sync` when they're done making changes. A mounted
+    `SpaghettiFS` checks its policy on a timer, from its `Checkpointer`.
+
+    The default policy commits after every operation.
+    """
+
+    def __init__(self, max_operations=1, max_bytes=None, max_delay=None):
+        self.max_operations = max_operations
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.reset()
+
+    def reset(self):
+        self.operations = 0
+        self.bytes = 0
+        self.first_change = None
+
+    def record(self, operations=0, nbytes=0):
+        if self.first_change is None:
+            self.first_change = time()
+        self.operations += operations
+        self.bytes += nbytes
+
+    def pending(self):
+        return self.first_change is not None
+
+    def should_commit(self):
+        if not self.pending():
+            return False
+        if self.max_operations is not None:
+            if self.operations >= self.max_operations:
+                return True
+        if self.max_bytes is not None:
+            if self.bytes >= self.max_bytes:
+                return True
+        if self.max_delay is not None:
+            if time() - self.first_change >= self.max_delay:
+                return True
+        return False
+
 class GitStorage(object):
     commit_author = "Spaghetti User <noreply@grep.ro>"
+    max_dirty_bytes = 64 * 1024 * 1024 # 64 MB of buffered inode blocks
+    # files expected to reach these sizes get larger blocks
+    large_file_blocksizes = [(256 * 1024 * 1024, 4 * 1024 * 1024),
+                             (16 * 1024 * 1024, 1024 * 1024)]
 
     @classmethod
-    def create(cls, repo_path):
+    def create(cls, repo_path, default_blocksize=None, inline_max_size=4096,
+               file_layout='blocks'):
         if not os.path.isdir(repo_path):
             os.mkdir(repo_path)
 
@@ -65,71 +129,220 @@ class GitStorage(object):
         features['next_inode_number'] = 1
         features['inode_index_format'] = 'treetree'
         features['inode_format'] = 'treetree'
+        features['dir_format'] = 'hashed'
+        features['inode_meta_format'] = 'table'
+        if default_blocksize is not None:
+            features['default_blocksize'] = default_blocksize
+        # inline data takes the place of block 0, so it fits in one block
+        features['inline_max_size'] = min(inline_max_size,
+                default_blocksize or StorageInode.default_blocksize)
+        if file_layout != 'blocks':
+            features['file_layout'] = file_layout
 
         eg.commit(cls.commit_author, 'Created empty filesystem')
 
         return cls(repo_path)
 
     def __init__(self, repo_path, autocommit=True):
+        """
+        `autocommit` is either False, True (commit after every operation)
+        or a `CommitPolicy`; with a policy, call `sync` to commit what it
+        has held back.
+        """
         self.eg = EasyGit.open_repo(repo_path)
         features = FeatureBlob(self.eg.root['features'])
         assert features.get('inode_format', None) == 'treetree'
         assert features.get('inode_index_format', None) == 'treetree'
+        self.dir_format = features.get('dir_format', None)
+        assert self.dir_format in (None, 'hashed')
+        assert features.get('inode_meta_format', None) in (None, 'table')
+        self.meta_table = open_meta_table(self.eg)
+        self.default_blocksize = features.get('default_blocksize',
+                                              StorageInode.default_blocksize)
+        # files up to this size are stored inline; older versions don't
+        # know about inline data, so it's off unless the feature is set
+        self.inline_max_size = features.get('inline_max_size', 0)
+        # layout of new files: fixed-size 'blocks' or 'chunked'
+        self.file_layout = features.get('file_layout', 'blocks')
+        assert self.file_layout in ('blocks', 'chunked')
+        if autocommit is True:
+            autocommit = CommitPolicy()
         self.autocommit = autocommit
+        self._operation_depth = 0
         log.debug('Loaded storage, autocommit=%r, HEAD=%r',
                   autocommit, self.eg.get_head_id())
         self._inode_cache = {}
+        self._dirty_inodes = {}
+        self._dirty_bytes = 0
+        # guards the git tree and the bookkeeping of dirty inodes; when
+        # both are needed, an inode's `lock` is taken before this one
+        self.lock = threading.RLock()
         self._inodes_tt = TreeTree(self.eg.root['inodes'], prefix='it')
 
     def get_root(self):
         commit_tree = self.eg.root
-        root_ls = commit_tree['root.ls']
+        root_ls = self._listing(commit_tree, 'root.ls')
         root_sub = commit_tree['root.sub']
         root = StorageDir('root', root_ls, root_sub, '/', self, None)
         root.path = '/'
         return root
 
+    def _listing(self, container, name):
+        # flat listings (no `dir_format`) are never split, so that older
+        # versions can still read the repository
+        container[name] # raises KeyError if the listing is missing
+        return Listing(container, name, sharded=(self.dir_format == 'hashed'))
+
     def get_inode(self, name):
-        if name in self._inode_cache:
-            inode = self._inode_cache[name]()
-            if inode is None:
-                del self._inode_cache[name]
-            else:
-                return inode
+        with self.lock:
+            if name in self._inode_cache:
+                inode = self._inode_cache[name]()
+                if inode is None:
+                    del self._inode_cache[name]
+                else:
+                    return inode
 
-        inode_tree = self._inodes_tt[name[1:]]
-        inode = StorageInode(name, inode_tree, self)
-        self._inode_cache[name] = weakref.ref(inode)
+            inode_tree = self._inodes_tt[name[1:]]
+            inode = make_inode(name, inode_tree, self, self.meta_table)
+            self._inode_cache[name] = weakref.ref(inode)
 
-        return inode
+            return inode
 
-    def create_inode(self):
+    def pick_blocksize(self, size_hint=None):
+        """ Block size for a file that is expected to be `size_hint` long """
+        if size_hint is not None:
+            for min_size, blocksize in self.large_file_blocksizes:
+                if size_hint >= min_size:
+                    return max(blocksize, self.default_blocksize)
+        return self.default_blocksize
+
+    def create_inode(self, size_hint=None):
         features = FeatureBlob(self.eg.root['features'])
         next_inode_number = features['next_inode_number']
         features['next_inode_number'] = next_inode_number + 1
 
         inode_name = 'i%d' % next_inode_number
         inode_tree = self._inodes_tt.new_tree(inode_name[1:])
-        inode_tree.new_blob('meta').data = StorageInode.default_meta
-        return self.get_inode(inode_name)
+        # with a meta table, a missing record reads as `default_meta`
+        if self.meta_table is None:
+            inode_tree.new_blob('meta').data = StorageInode.default_meta
+        if self.file_layout == 'chunked':
+            inode_tree.new_blob('chunks').data = ''
+        inode = self.get_inode(inode_name)
+        if self.file_layout == 'blocks':
+            inode['blocksize'] = self.pick_blocksize(size_hint)
+        inode.touch()
+        return inode
 
     def _remove_inode(self, name):
-        if name in self._inode_cache:
-            del self._inode_cache[name]
+        with self.lock:
+            if name in self._inode_cache:
+                del self._inode_cache[name]
+            self._dirty_inodes.pop(name, None)
+
+    def _inode_dirty(self, inode, nbytes=0):
+        if self._dirty_bytes + nbytes > self.max_dirty_bytes:
+            log.debug('Dirty buffers over %d bytes, flushing',
+                      self.max_dirty_bytes)
+            # inodes busy in other threads are flushed later
+            self.flush_inodes(wait=False)
+        with self.lock:
+            self._dirty_inodes[inode.name] = inode
+            self._dirty_bytes += nbytes
+
+    def _inode_flushed(self, inode, nbytes):
+        with self.lock:
+            self._dirty_inodes.pop(inode.name, None)
+            self._dirty_bytes -= nbytes
+
+    def _dirty_dropped(self, nbytes):
+        """ Account for buffers that were thrown away, not flushed. """
+        with self.lock:
+            self._dirty_bytes -= nbytes
+
+    def flush_inodes(self, wait=True):
+        """
+        Save the write-back buffers of all inodes to the git tree. With
+        `wait=False`, skip inodes that are locked by another thread.
+        """
+        with self.lock:
+            dirty_inodes = self._dirty_inodes.values()
+        for inode in dirty_inodes:
+            if not inode.lock.acquire(wait):
+                continue
+            try:
+                inode.flush()
+            finally:
+                inode.lock.release()
+
+    @contextmanager
+    def operation(self):
+        """
+        Group the changes made inside the `with` block into a single
+        operation, so they are autocommitted together.
+        """
+        self._operation_depth += 1
+        try:
+            yield
+        finally:
+            self._operation_depth -= 1
+        self._autocommit()
+
+    def _autocommit(self, nbytes=0):
+        if not self.autocommit:
+            return
+        if self._operation_depth > 0:
+            self.autocommit.record(nbytes=nbytes)
+            return
+        self.autocommit.record(operations=1, nbytes=nbytes)
+        if self.autocommit.should_commit():
+            self.commit("Auto commit")
 
-    def _autocommit(self):
-        if self.autocommit:
+    def sync(self):
+        """ Commit any changes that autocommit has not saved yet. """
+        if self.autocommit and self.autocommit.pending():
             self.commit("Auto commit")
 
     def commit(self, message=None, amend=False, head_id=None, branch='master'):
         log.info('Committing')
-
+        self.write_commit(self.snapshot(), message, amend, head_id, branch)
+
+    def snapshot(self):
+        """
+        First half of a commit: save buffered data and serialize the
+        changed trees; return the root tree id. This is the part that
+        needs the tree to hold still. Pass the id to `write_commit`.
+        """
+        self.flush_inodes()
+        with self.lock:
+            tree_id = self.eg.snapshot()
+            if self.autocommit:
+                self.autocommit.reset()
+        return tree_id
+
+    def write_commit(self, tree_id, message=None, amend=False, head_id=None,
+                     branch='master'):
+        """
+        Second half of a commit: write the objects of a `snapshot` and
+        a commit of `tree_id`. Changes may be made meanwhile; they go in
+        the next commit. Nothing is written if the commit would only
+        repeat the head of `branch`.
+        """
+        git = self.eg.git
+        try:
+            branch_head_id = self.eg.get_head_id(branch)
+        except KeyError:
+            branch_head_id = None
         if head_id is None:
-            head_id = self.eg.get_head_id(branch)
+            head_id = branch_head_id
+
+        prev_commit = git.commit(head_id)
+        if head_id == branch_head_id and prev_commit.tree == tree_id:
+            if not amend or message in (None, prev_commit.message):
+                log.info('Nothing to commit')
+                return
 
         if amend:
-            git = self.eg.git
-            prev_commit = git.commit(head_id)
             parents = prev_commit.parents
             if message is None:
                 message = prev_commit.message
@@ -138,66 +351,292 @@ class GitStorage(object):
 
         assert message is not None
 
-        self.eg.commit(self.commit_author, message, parents,
-                       branch=branch)
+        self.eg.write_commit(tree_id, self.commit_author, message, parents,
+                             branch=branch)
+
+class Listing(object):
+    """
+    Directory listing, stored as a tree of "bucket" blobs. Each bucket holds
+    lines of the form "<quoted name> <value>". When sharding is enabled
+    (the "hashed" `dir_format`), a bucket that grows past
+    `max_bucket_entries` is replaced by a tree of 16 buckets, keyed on the
+    next hex digit of the sha1 of entry names, so that a change only
+    rewrites one small bucket. A listing that was never split is a single
+    blob, identical to the flat format.
+    """
+
+    max_bucket_entries = 512
+
+    def __init__(self, container, name, sharded=True):
+        self.container = container # tree that holds our top node
+        self.name = name
+        self.sharded = sharded
+
+    def _find_bucket(self, name):
+        digits = hashlib.sha1(name).hexdigest()
+        parent, key = self.container, self.name
+        depth = 0
+        node = parent[key]
+        while node.is_tree:
+            parent, key = node, digits[depth]
+            node = parent[key]
+            depth += 1
+        return parent, key, depth
+
+    def _iter_buckets(self, node):
+        if node.is_tree:
+            for key in sorted(node.keys()):
+                for bucket in self._iter_buckets(node[key]):
+                    yield bucket
+        else:
+            yield node
+
+    def __iter__(self):
+        for bucket in self._iter_buckets(self.container[self.name]):
+            for name in list(bucket_entries(bucket)):
+                yield name
+
+    def iteritems(self):
+        for bucket in self._iter_buckets(self.container[self.name]):
+            for name, value in bucket_entries(bucket).items():
+                yield name, value
+
+    def __getitem__(self, name):
+        parent, key, depth = self._find_bucket(name)
+        return bucket_entries(parent[key])[name]
+
+    def __contains__(self, name):
+        try:
+            self[name]
+        except KeyError:
+            return False
+        else:
+            return True
+
+    def add(self, name, value):
+        parent, key, depth = self._find_bucket(name)
+        def update(entries, b):
+            b.data += "%s %s\n" % (quote(name), value)
+            entries[name] = value
+        entries = update_bucket(parent[key], update)
+
+        if self.sharded and len(entries) > self.max_bucket_entries:
+            self._split(parent, key, depth)
+
+    def remove(self, name):
+        parent, key, depth = self._find_bucket(name)
+        def update(entries, b):
+            assert name in entries
+            del entries[name]
+            b.data = format_entries(entries)
+        update_bucket(parent[key], update)
+
+    def remove_all(self):
+        del self.container[self.name]
+
+    def _split(self, parent, key, depth):
+        log.debug('Splitting listing bucket %r at depth %d', key, depth)
+        children = dict(('%x' % c, collections.OrderedDict())
+                        for c in range(16))
+        for name, value in bucket_entries(parent[key]).iteritems():
+            digit = hashlib.sha1(name).hexdigest()[depth]
+            children[digit][name] = value
+
+        del parent[key]
+        with parent.new_tree(key) as tree:
+            for digit, entries in children.iteritems():
+                b = tree.new_blob(digit)
+                b.data = format_entries(entries)
+                listing_cache.put(b.git_id, entries)
+
+            for digit, entries in children.iteritems():
+                if len(entries) > self.max_bucket_entries:
+                    self._split(tree, digit, depth + 1)
+
+    def reshard(self):
+        """ Split any buckets that are over `max_bucket_entries`. """
+        def walk(parent, key, depth):
+            node = parent[key]
+            if node.is_tree:
+                for child_key in node.keys():
+                    walk(node, child_key, depth + 1)
+            elif len(bucket_entries(node)) > self.max_bucket_entries:
+                self._split(parent, key, depth)
+        walk(self.container, self.name, 0)
+
+class InodeMetaTable(object):
+    """
+    Inode metadata for the "table" `inode_meta_format`: one fixed-width
+    binary record per inode, packed into table blobs of
+    `records_per_table` records each. Inode numbers are allocated in
+    sequence, so the files of one directory usually share a few tables.
+    Tables are kept in a treetree, keyed by table number, in the `name`
+    tree of `container`, which is created on first write. A record with a
+    `mode` of 0 is empty.
+    """
+
+    fields = ('mode', 'nlink', 'uid', 'gid', 'size', 'mtime', 'ctime',
+              'blocksize')
+    record = struct.Struct('<IIIIQqqI')
+    records_per_table = 256
+
+    def __init__(self, container, name='inode_meta'):
+        self.container = container
+        self.name = name
+
+    def _tables(self, create=False):
+        try:
+            tree = self.container[self.name]
+        except KeyError:
+            if not create:
+                return None
+            tree = self.container.new_tree(self.name)
+        return TreeTree(tree, prefix='mt')
+
+    def _locate(self, number):
+        table_name = str(number / self.records_per_table)
+        offset = (number % self.records_per_table) * self.record.size
+        return table_name, offset
+
+    def get(self, number):
+        """ Return the metadata of inode `number`, or None if it has none. """
+        table_name, offset = self._locate(number)
+        tables = self._tables()
+        if tables is None:
+            return None
+        try:
+            data = tables[table_name].data
+        except KeyError:
+            return None
+        if len(data) < offset + self.record.size:
+            return None
+        values = self.record.unpack_from(data, offset)
+        if values[0] == 0:
+            return None
+        meta = dict(zip(self.fields, values))
+        if not meta['blocksize']:
+            del meta['blocksize'] # use the inode's default
+        return meta
+
+    def set(self, number, meta):
+        record = self.record.pack(*[meta.get(field, 0)
+                                    for field in self.fields])
+        self._write_record(number, record)
+
+    def remove(self, number):
+        self._write_record(number, '\0' * self.record.size)
+
+    def _write_record(self, number, record):
+        table_name, offset = self._locate(number)
+        tables = self._tables(create=True)
+        try:
+            table = tables[table_name]
+        except KeyError:
+            table = None
+            data = ''
+        else:
+            data = table.data
+
+        if len(data) < offset:
+            data += '\0' * (offset - len(data))
+        data = data[:offset] + record + data[offset + len(record):]
+
+        if not data.strip('\0'):
+            if table is not None:
+                del tables[table_name]
+            return
+        if table is None:
+            table = tables.new_blob(table_name)
+        table.data = data
+
+def open_meta_table(eg):
+    """ Return the `InodeMetaTable` of a repository, if it uses one. """
+    features = FeatureBlob(eg.root['features'])
+    if features.get('inode_meta_format', None) == 'table':
+        return InodeMetaTable(eg.root)
+    return None
 
 class StorageDir(object, UserDict.DictMixin):
     is_dir = True
 
-    def __init__(self, name, ls_blob, sub_tree, path, storage, parent):
+    def __init__(self, name, listing, sub_tree, path, storage, parent):
         self.name = name
-        self.ls_blob = ls_blob # blob that lists our contents
-        self.sub_tree = sub_tree # tree that keeps our subfolders
+        self.listing = listing # `Listing` of our contents
+        # tree that keeps our subfolders; None until we get the first one
+        self.sub_tree = sub_tree
         self.path = path
         self.storage = storage
         self.parent = parent
         log.debug('Loaded folder %r', name)
 
-    def _iter_contents(self):
-        return iter_entries(self.ls_blob.data)
+    def _get_sub_tree(self, create=False):
+        """
+        Return the tree that keeps our subfolders, or None if there is
+        none yet. Reading a folder never writes, so the tree is only made,
+        with `create`, when a subfolder is added.
+        """
+        if self.sub_tree is None:
+            # another `StorageDir` of this folder may have made it since
+            sub_name = quote(self.name) + '.sub'
+            parent_sub = self.parent._get_sub_tree(create)
+            try:
+                self.sub_tree = parent_sub[sub_name]
+            except KeyError:
+                if create:
+                    self.sub_tree = parent_sub.new_tree(sub_name)
+        return self.sub_tree
+
+    # lookups only hold the filesystem's namespace lock for reading, and
+    # the trees they load are shared, so they also take `storage.lock`
 
     def keys(self):
-        for name, value in self._iter_contents():
-            yield name
+        with self.storage.lock:
+            return list(self.listing)
 
-    def __getitem__(self, key):
-        for name, value in self._iter_contents():
-            if key == name:
-                break
-        else:
-            raise KeyError('Folder entry %s not found' % repr(key))
+    def __contains__(self, key):
+        with self.storage.lock:
+            return key in self.listing
+
+    def __getitem__(self, name):
+        with self.storage.lock:
+            try:
+                value = self.listing[name]
+            except KeyError:
+                raise KeyError('Folder entry %s not found' % repr(name))
+
+            if value != '/':
+                inode = self.storage.get_inode(value)
+                return StorageFile(name, inode, self)
 
-        if value == '/':
             qname = quote(name)
-            child_ls = self.sub_tree[qname + '.ls']
+            sub_tree = self._get_sub_tree()
+            if sub_tree is None:
+                # no subfolders were ever made, so there's no listing
+                raise KeyError('Listing of folder %r is missing' % name)
+            child_ls = self.storage._listing(sub_tree, qname + '.ls')
             try:
-                child_sub = self.sub_tree[qname + '.sub']
+                child_sub = sub_tree[qname + '.sub']
             except KeyError:
-                child_sub = self.sub_tree.new_tree(qname + '.sub')
-                self.storage._autocommit()
+                child_sub = None
             return StorageDir(name, child_ls, child_sub,
                               self.path + name + '/',
                               self.storage, self)
-        else:
-            inode = self.storage.get_inode(value)
-            return StorageFile(name, inode, self)
 
-    def create_file(self, name, inode=None):
+    def create_file(self, name, inode=None, size_hint=None):
         check_filename(name)
 
-        if inode is None:
-            log.info('Creating file %r in %r', name, self.path)
-            inode = self.storage.create_inode()
-        else:
-            assert(inode.storage is self.storage)
-            log.info('Linking file %r in %r to inode %r',
-                     name, self.path, inode.name)
-            inode['nlink'] += 1
-
-        with self.ls_blob as b:
-            b.data += "%s %s\n" % (quote(name), inode.name)
+        with self.storage.operation():
+            if inode is None:
+                log.info('Creating file %r in %r', name, self.path)
+                inode = self.storage.create_inode(size_hint)
+            else:
+                assert(inode.storage is self.storage)
+                log.info('Linking file %r in %r to inode %r',
+                         name, self.path, inode.name)
+                inode['nlink'] += 1
+                inode.touch(mtime=False)
 
-        self.storage._autocommit()
+            self.listing.add(name, inode.name)
 
         return self[name]
 
@@ -211,124 +650,300 @@ class StorageDir(object, UserDict.DictMixin):
         log.info('Creating directory %s in %s', repr(name), repr(self.path))
 
         qname = quote(name)
-        with self.sub_tree as st:
+        with self._get_sub_tree(create=True) as st:
             child_ls_blob = st.new_blob(qname + '.ls')
-        with self.ls_blob as b:
-            b.data += "%s /\n" % qname
+        self.listing.add(name, '/')
 
         self.storage._autocommit()
 
         return self[name]
 
     def remove_ls_entry(self, rm_name):
-        ls_data = ''
-        removed_count = 0
-        for name, value in self._iter_contents():
-            if name == rm_name:
-                log.debug('Removing ls entry %s from %s',
-                          repr(rm_name), repr(self.path))
-                removed_count += 1
-            else:
-                ls_data += '%s %s\n' % (quote(name), value)
-        assert removed_count == 1
-
-        with self.ls_blob as b:
-            b.data = ls_data
+        log.debug('Removing ls entry %s from %s',
+                  repr(rm_name), repr(self.path))
+        self.listing.remove(rm_name)
 
         self.storage._autocommit()
 
     def unlink(self):
         log.info('Removing folder %s', repr(self.path))
 
-        self.ls_blob.remove()
-        self.sub_tree.remove()
-        self.parent.remove_ls_entry(self.name)
-
-        self.storage._autocommit()
+        with self.storage.operation():
+            self.listing.remove_all()
+            if self._get_sub_tree() is not None:
+                self.sub_tree.remove()
+            self.parent.remove_ls_entry(self.name)
 
 class StorageInode(object):
-    blocksize = 64*1024 # 64 KB
-    #blocksize = 1024*1024 # 1024 KB
+    default_blocksize = 64*1024 # 64 KB, the block size of older inodes
 
     default_meta = ('mode: 0100644\n'
                     'nlink: 1\n'
                     'uid: 0\n'
                     'gid: 0\n'
                     'size: 0\n')
-    int_meta = ('nlink', 'uid', 'gid', 'size')
+    int_meta = ('nlink', 'uid', 'gid', 'size', 'mtime', 'ctime', 'blocksize')
     oct_meta = ('mode',)
+    # inodes written before timestamps were recorded report the epoch
+    meta_defaults = {'mtime': 0, 'ctime': 0, 'blocksize': default_blocksize}
+    max_readahead_bytes = 2*1024*1024 # 2 MB
 
-    def __init__(self, name, tree, storage):
+    def __init__(self, name, tree, storage, meta_table=None):
         self.name = name
         self.tree = tree
         self.storage = storage
         self.tt = TreeTree(tree, prefix='bt')
+        # `InodeMetaTable` for the "table" `inode_meta_format`; otherwise
+        # metadata is kept in a text blob in the inode's tree
+        self.meta_table = meta_table
+        # write-back buffers, saved to git by `flush`
+        self._dirty_blocks = {}
+        # parsed metadata, loaded on first access
+        self._meta = None
+        self._meta_dirty = False
+        # read-ahead state: where a sequential read would continue, how
+        # many blocks to prefetch, and the first block not yet prefetched
+        self._readahead_next = 0
+        self._readahead_window = 0
+        self._readahead_until = 0
+        # set when the last link is removed; open file handles can still
+        # reach the inode, but its tree is gone, so changes are dropped
+        self._unlinked = False
+        # held by callers while they use the inode from several threads
+        self.lock = threading.RLock()
         log.debug('Loaded inode %r', name)
 
     def _read_meta(self):
-        try:
-            meta_blob = self.tree['meta']
-        except KeyError:
+        if self.meta_table is not None:
+            meta = self.meta_table.get(int(self.name[1:]))
+            if meta is not None:
+                return dict((key, self._format_meta_value(key, value))
+                            for key, value in meta.iteritems())
             meta_raw = self.default_meta
         else:
-            meta_raw = meta_blob.data
+            try:
+                meta_blob = self.tree['meta']
+            except KeyError:
+                meta_raw = self.default_meta
+            else:
+                meta_raw = meta_blob.data
 
         return dict(line.split(': ', 1)
                     for line in meta_raw.strip().split('\n'))
 
-    def _write_meta(self, meta_data):
-        meta_raw = ''.join('%s: %s\n' % (key, value)
-                           for key, value in sorted(meta_data.items()))
-        self.tree.new_blob('meta').data = meta_raw
-        self.storage._autocommit()
-
-    def __getitem__(self, key):
-        value = self._read_meta()[key]
-
+    def _load_meta(self):
+        """ Return the parsed metadata, reading it the first time. """
+        if self._meta is None:
+            # the meta table is shared with other inodes, which may be
+            # flushing into it
+            with self.storage.lock:
+                meta = None
+                if self.meta_table is not None:
+                    meta = self.meta_table.get(int(self.name[1:]))
+                if meta is None:
+                    meta = dict((key, self._parse_meta_value(key, value))
+                                for key, value
+                                in self._read_meta().iteritems())
+            self._meta = meta
+        return self._meta
+
+    def _write_meta(self, meta):
+        if self.meta_table is not None:
+            self.meta_table.set(int(self.name[1:]), meta)
+            return
+
+        lines = ['%s: %s\n' % (key, self._format_meta_value(key, value))
+                 for key, value in sorted(meta.items())]
+        self.tree.new_blob('meta').data = ''.join(lines)
+
+    def _parse_meta_value(self, key, value):
         if key in self.oct_meta:
-            value = int(value, base=8)
+            return int(value, base=8)
         elif key in self.int_meta:
-            value = int(value)
-
+            return int(value)
         return value
 
-    def __setitem__(self, key, value):
+    def _format_meta_value(self, key, value):
         if key in self.oct_meta:
-            value = '0%o' % value
+            return '0%o' % value
         elif key in self.int_meta:
-            value = '%d' % value
-        else:
+            return '%d' % value
+        return value
+
+    def __getitem__(self, key):
+        meta = self._load_meta()
+        if key in meta:
+            return meta[key]
+        elif key in self.meta_defaults:
+            return self.meta_defaults[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        self._set_meta(key, value)
+        self.storage._autocommit()
+
+    def _set_meta(self, key, value):
+        if key not in self.oct_meta and key not in self.int_meta:
             raise NotImplementedError
 
-        meta_data = self._read_meta()
-        meta_data[key] = value
-        self._write_meta(meta_data)
+        self._load_meta()[key] = value
+        self._meta_dirty = True
+        self.storage._inode_dirty(self)
 
-    def read_block(self, n):
-        block_name = str(n)
-        log.debug('Reading block %r of inode %r', block_name, self.name)
+    @property
+    def blocksize(self):
+        return self['blocksize']
+
+    def _pick_blocksize(self, size_hint):
+        """
+        Switch an empty inode to larger blocks if it's going to be large.
+        The block size is never lowered, so that a hint given when the
+        file was created is kept.
+        """
+        if self._dirty_blocks:
+            return
+        blocksize = self.storage.pick_blocksize(size_hint)
+        if blocksize > self.blocksize:
+            log.debug('Inode %r switching to %d byte blocks',
+                      self.name, blocksize)
+            self._set_meta('blocksize', blocksize)
+
+    def flush(self):
+        """ Save buffered blocks and metadata changes to the git tree. """
+        with self.lock:
+            with self.storage.lock:
+                if self._unlinked:
+                    self._discard_buffers()
+                else:
+                    self._flush()
+
+    def _flush(self):
+        nbytes = self._flush_data()
+
+        if self._meta_dirty:
+            self._write_meta(self._meta)
+            self._meta_dirty = False
+
+        self.storage._inode_flushed(self, nbytes)
+
+    def _flush_data(self):
+        """ Save buffered data; return the bytes it was accounted as. """
+        if self._dirty_blocks:
+            log.debug('Flushing %d blocks of inode %r',
+                      len(self._dirty_blocks), self.name)
+        nbytes = len(self._dirty_blocks) * self.blocksize
+
+        # small files keep their data in a single `data` blob, instead of
+        # a treetree of blocks; move block 0 when a file crosses the limit
+        size = self['size']
+        inline = 0 < size <= min(self.storage.inline_max_size, self.blocksize)
+        blocks = dict(self._dirty_blocks)
+        if inline != (self._inline_blob() is not None) and 0 not in blocks:
+            blocks[0] = self._get_block(0)
+
+        for n, block in sorted(blocks.iteritems()):
+            self._save_block(n, str(block), inline)
+        self._dirty_blocks.clear()
+        return nbytes
+
+    def touch(self, mtime=True):
+        """ Update `ctime`, and `mtime` unless told otherwise. """
+        now = int(time())
+        with self.storage.operation():
+            if mtime:
+                self['mtime'] = now
+            self['ctime'] = now
+
+    def _discard_buffers(self):
+        nbytes = self._discard_data()
+        self._meta_dirty = False
+        self.storage._inode_flushed(self, nbytes)
+
+    def _discard_data(self):
+        nbytes = len(self._dirty_blocks) * self.blocksize
+        self._dirty_blocks.clear()
+        return nbytes
+
+    def _inline_blob(self):
         try:
-            block = self.tt[block_name]
+            return self.tree['data']
         except KeyError:
-            return ''
-        else:
-            return block.data
+            return None
+
+    def _save_block(self, n, data, inline=False):
+        if inline:
+            assert n == 0
+            blob = self._inline_blob()
+            if blob is None:
+                blob = self.tree.new_blob('data')
+            blob.data = data
+            self._remove_block(0, inline=False)
+            return
 
-    def write_block(self, n, data):
         block_name = str(n)
-        log.debug('Writing block %r of inode %r', block_name, self.name)
         try:
             block = self.tt[block_name]
         except KeyError:
             block = self.tt.new_blob(block_name)
         block.data = data
+        if n == 0 and self._inline_blob() is not None:
+            del self.tree['data']
+
+    def _remove_block(self, n, inline=True):
+        """ Remove block `n` from git, and the inline data if `inline` """
+        with self.storage.lock:
+            if n == 0 and inline and self._inline_blob() is not None:
+                del self.tree['data']
+            try:
+                del self.tt[str(n)]
+            except KeyError:
+                pass # block was only buffered
+
+    def _get_block(self, n):
+        """ Block data, as a string or (if buffered) a bytearray """
+        if n in self._dirty_blocks:
+            return self._dirty_blocks[n]
+
+        block_name = str(n)
+        log.debug('Reading block %r of inode %r', block_name, self.name)
+        # trees are looked up under the lock; the data is read outside it
+        with self.storage.lock:
+            blob = None
+            if n == 0:
+                blob = self._inline_blob()
+            if blob is None:
+                try:
+                    blob = self.tt[block_name]
+                except KeyError:
+                    return ''
+        return blob.data
+
+    def _drop_dirty_block(self, n):
+        """ Throw away the buffer of block `n`, if it has one. """
+        if self._dirty_blocks.pop(n, None) is not None:
+            self.storage._dirty_dropped(self.blocksize)
+
+    def _get_dirty_block(self, n):
+        """ Writable buffer for block `n` """
+        if n not in self._dirty_blocks:
+            self.storage._inode_dirty(self, self.blocksize)
+            self._dirty_blocks[n] = bytearray(self._get_block(n))
+        return self._dirty_blocks[n]
+
+    def read_block(self, n):
+        return str(self._get_block(n))
+
+    def write_block(self, n, data):
+        log.debug('Writing block %r of inode %r', n, self.name)
+        self._get_dirty_block(n)[:] = data
 
         self.storage._autocommit()
 
     def delete_block(self, n):
         block_name = str(n)
         log.debug('Removing block %r of inode %r', block_name, self.name)
-        del self.tt[block_name]
+        self._drop_dirty_block(n)
+        self._remove_block(n)
 
         self.storage._autocommit()
 
@@ -340,50 +955,87 @@ class StorageInode(object):
             length = end - offset
             if length <= 0:
                 return ''
-        first_block = offset / self.blocksize
-        last_block = end / self.blocksize
+        blocksize = self.blocksize
+        first_block = offset / blocksize
+        last_block = end / blocksize
 
         output = StringIO()
         for n_block in range(first_block, last_block+1):
-            block_offset = n_block * self.blocksize
+            block_offset = n_block * blocksize
 
             fragment_offset = 0
             if n_block == first_block:
                 fragment_offset = offset - block_offset
 
-            fragment_end = self.blocksize
+            fragment_end = blocksize
             if n_block == last_block:
                 fragment_end = end - block_offset
 
-            block_data = self.read_block(n_block)
+            block_data = self._get_block(n_block)
             fragment = block_data[fragment_offset:fragment_end]
-            assert len(fragment) == fragment_end - fragment_offset
-            output.write(fragment)
+            output.write(str(fragment))
+            # missing blocks, and the missing ends of blocks, are holes
+            hole_size = fragment_end - fragment_offset - len(fragment)
+            if hole_size:
+                output.write('\0' * hole_size)
 
         output = output.getvalue()
         assert len(output) == length
+        self._read_ahead(offset, end, eof)
         return output
 
+    def _read_ahead(self, offset, end, eof):
+        """ Detect sequential reads and prefetch the blocks that follow. """
+        if offset != self._readahead_next:
+            self._readahead_next = end
+            self._readahead_window = 0
+            self._readahead_until = 0
+            return
+
+        blocksize = self.blocksize
+        max_window = max(self.max_readahead_bytes / blocksize, 1)
+        self._readahead_next = end
+        self._readahead_window = min(max(self._readahead_window * 2, 4),
+                                     max_window)
+
+        first_block = max(end / blocksize + 1, self._readahead_until)
+        last_block = min(end / blocksize + self._readahead_window,
+                         (eof - 1) / blocksize)
+        for n_block in range(first_block, last_block + 1):
+            if n_block in self._dirty_blocks:
+                continue
+            try:
+                with self.storage.lock:
+                    block = self.tt[str(n_block)]
+            except KeyError:
+                continue # hole
+            blob_prefetcher.prefetch(block)
+        self._readahead_until = max(self._readahead_until, last_block + 1)
+
     def write_data(self, data, offset):
+        if self._unlinked:
+            return
+
         current_size = self['size']
-        if current_size < offset:
-            self.truncate(offset)
 
         log.info('Inode %s writing %d bytes at offset %d',
                  repr(self.name), len(data), offset)
 
         end = offset + len(data)
-        first_block = offset / self.blocksize
-        last_block = end / self.blocksize
+        if current_size == 0:
+            self._pick_blocksize(end)
+        blocksize = self.blocksize
+        first_block = offset / blocksize
+        last_block = end / blocksize
 
         for n_block in range(first_block, last_block+1):
-            block_offset = n_block * self.blocksize
+            block_offset = n_block * blocksize
 
             insert_offset = 0
             if n_block == first_block:
                 insert_offset = offset - block_offset
 
-            insert_end = self.blocksize
+            insert_end = blocksize
             if n_block == last_block:
                 insert_end = end - block_offset
 
@@ -395,51 +1047,333 @@ class StorageInode(object):
                       n_block, insert_offset, insert_end,
                       data_start, data_end)
 
-            current_data = self.read_block(n_block)
-            datafile = StringIO()
-            datafile.write(current_data)
-            datafile.seek(insert_offset)
-            datafile.write(data[data_start:data_end])
-            self.write_block(n_block, datafile.getvalue())
+            if insert_end == insert_offset:
+                continue # nothing to write in this block
 
-        if end > current_size:
-            self['size'] = end
+            block = self._get_dirty_block(n_block)
+            if len(block) < insert_offset:
+                block.extend('\0' * (insert_offset - len(block)))
+            block[insert_offset:insert_end] = data[data_start:data_end]
+
+        with self.storage.operation():
+            if end > current_size:
+                self['size'] = end
+            self.touch()
+            self.storage._autocommit(len(data))
 
     def truncate(self, new_size):
         log.info("Truncating inode %s, new size %d", repr(self.name), new_size)
+        if self._unlinked:
+            return
 
+        # blocks never hold data past the end of the file, so extending it
+        # is just a matter of changing its size; the rest is a hole
         current_size = self['size']
-        if current_size < new_size:
-            # TODO: avoid creating one big string
-            self.write_data('\0' * (new_size - current_size), current_size)
-
+        if current_size == 0:
+            self._pick_blocksize(new_size)
         elif current_size > new_size:
-            first_block = new_size / self.blocksize
-            last_block = current_size / self.blocksize
-            truncate_offset = new_size % self.blocksize
+            blocksize = self.blocksize
+            first_block = new_size / blocksize
+            last_block = current_size / blocksize
+            truncate_offset = new_size % blocksize
 
             for n_block in range(first_block, last_block+1):
                 if n_block == first_block and truncate_offset > 0:
-                    old_data = self.read_block(n_block)
-                    self.write_block(n_block, old_data[:truncate_offset])
+                    block = self._get_dirty_block(n_block)
+                    del block[truncate_offset:]
                 else:
-                    self.delete_block(n_block)
+                    self._drop_dirty_block(n_block)
+                    self._remove_block(n_block)
 
-        self['size'] = new_size
+        with self.storage.operation():
+            self['size'] = new_size
+            self.touch()
 
     def unlink(self):
         log.info('Unlinking inode %r', self.name)
 
-        nlink = self['nlink'] - 1
-        if nlink > 0:
-            log.info('Links remaining for inode %r: %d', self.name, nlink)
-            self['nlink'] = nlink
+        with self.storage.operation():
+            nlink = self['nlink'] - 1
+            if nlink > 0:
+                log.info('Links remaining for inode %r: %d', self.name, nlink)
+                self['nlink'] = nlink
+                self.touch(mtime=False)
+            else:
+                log.info('Links remaining for inode %r: 0; removing.',
+                         self.name)
+                self._discard_buffers()
+                self._unlinked = True
+                self.storage._remove_inode(self.name)
+                with self.storage.lock:
+                    if self.meta_table is not None:
+                        self.meta_table.remove(int(self.name[1:]))
+                    self.tree.remove()
+
+class Chunker(object):
+    """
+    Content-defined chunking with a "gear" rolling hash. A chunk ends
+    after a byte where the top `mask_bits` bits of the hash, which depend
+    on the last 32 bytes, are all zero; so boundaries follow the content,
+    and an edit only changes the chunks around it. Chunks are between
+    `min_size` and `max_size` bytes, except for the last one.
+    """
+
+    gear = [struct.unpack('<I', hashlib.sha1(chr(n)).digest()[:4])[0]
+            for n in range(256)]
+
+    def __init__(self, min_size=16*1024, mask_bits=16, max_size=256*1024):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.mask = ((1 << mask_bits) - 1) << (32 - mask_bits)
+
+    def split(self, data):
+        """ Return the end offsets of the chunks of the string `data` """
+        gear, mask = self.gear, self.mask
+        cuts = []
+        start = 0
+        while start < len(data):
+            cut = min(start + self.max_size, len(data))
+            h = 0
+            # bytes before `min_size` can't end a chunk, so skip hashing
+            # all but the last 32 of them
+            for i in xrange(max(start, start + self.min_size - 32), cut):
+                h = ((h << 1) + gear[ord(data[i])]) & 0xffffffff
+                if not h & mask and i + 1 - start >= self.min_size:
+                    cut = i + 1
+                    break
+            cuts.append(cut)
+            start = cut
+        return cuts
+
+class ChunkedInode(StorageInode):
+    """
+    Inode whose data is split at content-defined boundaries (the
+    "chunked" `file_layout`), so that rewriting a file with an insertion,
+    or storing similar files, produces mostly the same chunk blobs, which
+    git stores only once. Chunk blobs are kept in a treetree, keyed by
+    chunk id; the `chunks` blob lists them in file order, as packed
+    (end offset, chunk id) records, and is searched with bisect.
+
+    Writes go to a buffer (the "span") that covers a contiguous range of
+    whole chunks; it is split into new chunks when the inode is flushed.
+    The span can only change length at the end of the stored data.
+    """
+
+    chunker = Chunker()
+    record = struct.Struct('<QQ')
+
+    def __init__(self, name, tree, storage, meta_table=None):
+        super(ChunkedInode, self).__init__(name, tree, storage, meta_table)
+        self.tt = TreeTree(tree, prefix='ct')
+        self._chunk_ends = None
+        self._chunk_ids = None
+        self._index_dirty = False
+        self._span = None
+        self._span_start = 0
+        self._span_old_end = 0 # where the span ends in the stored data
+        self._span_accounted = 0
+
+    def _load_index(self):
+        if self._chunk_ends is not None:
+            return
+        with self.storage.lock:
+            blob = self.tree['chunks']
+        data = blob.data
+        records = [self.record.unpack_from(data, offset)
+                   for offset in xrange(0, len(data), self.record.size)]
+        self._chunk_ends = [end for end, chunk_id in records]
+        self._chunk_ids = [chunk_id for end, chunk_id in records]
+
+    def _stored_end(self):
+        return self._chunk_ends[-1] if self._chunk_ends else 0
+
+    def _chunk_start(self, i):
+        return self._chunk_ends[i - 1] if i else 0
+
+    def _read_stored(self, start, end):
+        """ Read stored data; stops short at the end of the stored data. """
+        ends = self._chunk_ends
+        pieces = []
+        i = bisect.bisect_right(ends, start)
+        pos = start
+        while pos < end and i < len(ends):
+            chunk_start = self._chunk_start(i)
+            with self.storage.lock:
+                blob = self.tt[str(self._chunk_ids[i])]
+            chunk = blob.data
+            piece = chunk[pos - chunk_start:end - chunk_start]
+            pieces.append(piece)
+            pos += len(piece)
+            i += 1
+        return ''.join(pieces)
+
+    def read_data(self, offset, length):
+        end = min(offset + length, self['size'])
+        if end <= offset:
+            return ''
+        self._load_index()
+
+        pieces = []
+        pos = offset
+        if self._span is not None:
+            span_start = self._span_start
+            span_end = span_start + len(self._span)
+            if pos < span_start:
+                pieces.append(self._read_stored(pos, min(end, span_start)))
+                pos = min(end, span_start)
+            if pos < min(end, span_end):
+                pieces.append(str(self._span[pos - span_start:
+                                             min(end, span_end) - span_start]))
+                pos = min(end, span_end)
+        if pos < end:
+            # past a span that changed length, there is no stored data
+            pieces.append(self._read_stored(pos, end))
+
+        output = ''.join(pieces)
+        # anything past the stored data is a hole
+        return output + '\0' * (end - offset - len(output))
+
+    def _start_span(self, offset):
+        ends = self._chunk_ends
+        i = bisect.bisect_right(ends, min(offset, self._stored_end()))
+        if i == len(ends) and ends:
+            i -= 1 # appending: the last chunk is split again
+        self._span_start = self._span_old_end = self._chunk_start(i)
+        self._span = bytearray()
+
+    def _extend_span(self, end):
+        """ Load stored chunks into the span, until it reaches `end`. """
+        stored_end = self._stored_end()
+        if self._span_old_end >= stored_end:
+            return
+        if self._span_start + len(self._span) >= end:
+            return
+        i = bisect.bisect_right(self._chunk_ends, end - 1)
+        if i < len(self._chunk_ends):
+            new_old_end = self._chunk_ends[i]
         else:
-            log.info('Links remaining for inode %r: 0; removing.', self.name)
-            self.storage._remove_inode(self.name)
-            self.tree.remove()
+            new_old_end = stored_end
+        self._span.extend(self._read_stored(self._span_old_end, new_old_end))
+        self._span_old_end = new_old_end
 
-        self.storage._autocommit()
+    def write_data(self, data, offset):
+        log.info('Inode %s writing %d bytes at offset %d',
+                 repr(self.name), len(data), offset)
+        if not data or self._unlinked:
+            return
+
+        current_size = self['size']
+        end = offset + len(data)
+        self._load_index()
+        self.storage._inode_dirty(self, len(data))
+        self._span_accounted += len(data)
+
+        if self._span is not None:
+            span_end = self._span_start + len(self._span)
+            if not self._span_start <= offset <= span_end:
+                with self.storage.lock:
+                    self._save_span()
+        if self._span is None:
+            self._start_span(offset)
+        self._extend_span(end)
+
+        span_offset = offset - self._span_start
+        if len(self._span) < span_offset:
+            self._span.extend('\0' * (span_offset - len(self._span)))
+        self._span[span_offset:span_offset + len(data)] = data
+
+        with self.storage.operation():
+            if end > current_size:
+                self['size'] = end
+            self.touch()
+            self.storage._autocommit(len(data))
+
+    def truncate(self, new_size):
+        log.info("Truncating inode %s, new size %d", repr(self.name), new_size)
+        if self._unlinked:
+            return
+
+        self._load_index()
+        if new_size < self['size']:
+            self.flush()
+        if new_size < self._stored_end():
+            ends, ids = self._chunk_ends, self._chunk_ids
+            i = bisect.bisect_right(ends, new_size)
+            chunk_start = self._chunk_start(i)
+            tail = self._read_stored(chunk_start, new_size)
+            with self.storage.lock:
+                for chunk_id in ids[i:]:
+                    del self.tt[str(chunk_id)]
+            del ends[i:]
+            del ids[i:]
+            self._index_dirty = True
+            self.storage._inode_dirty(self, len(tail))
+            if tail:
+                # the partial chunk is split again on flush
+                self._span_accounted += len(tail)
+                self._span_start = self._span_old_end = chunk_start
+                self._span = bytearray(tail)
+
+        with self.storage.operation():
+            self['size'] = new_size
+            self.touch()
+
+    def _save_span(self):
+        """ Split the span into chunks and save them. """
+        data = str(self._span)
+        ends, ids = self._chunk_ends, self._chunk_ids
+        first = bisect.bisect_right(ends, self._span_start)
+        last = bisect.bisect_right(ends, self._span_old_end)
+        next_id = max(ids) + 1 if ids else 0
+
+        new_ends = []
+        new_ids = []
+        chunk_start = 0
+        for cut in self.chunker.split(data):
+            self.tt.new_blob(str(next_id)).data = data[chunk_start:cut]
+            new_ends.append(self._span_start + cut)
+            new_ids.append(next_id)
+            next_id += 1
+            chunk_start = cut
+
+        for chunk_id in ids[first:last]:
+            del self.tt[str(chunk_id)]
+        ends[first:last] = new_ends
+        ids[first:last] = new_ids
+        self._index_dirty = True
+        self._span = None
+
+    def _flush_data(self):
+        if self._span is not None:
+            log.debug('Flushing %d buffered bytes of inode %r',
+                      len(self._span), self.name)
+            self._save_span()
+        if self._index_dirty:
+            self.tree['chunks'].data = ''.join(
+                self.record.pack(end, chunk_id) for end, chunk_id
+                in zip(self._chunk_ends, self._chunk_ids))
+            self._index_dirty = False
+        nbytes, self._span_accounted = self._span_accounted, 0
+        return nbytes
+
+    def _discard_data(self):
+        self._span = None
+        self._index_dirty = False
+        nbytes, self._span_accounted = self._span_accounted, 0
+        return nbytes
+
+    def _inline_blob(self):
+        return None
+
+def make_inode(name, tree, storage, meta_table=None):
+    """ Open an inode with the class that matches its layout. """
+    try:
+        tree['chunks']
+    except KeyError:
+        cls = StorageInode
+    else:
+        cls = ChunkedInode
+    return cls(name, tree, storage, meta_table)
 
 class StorageFile(object):
     is_dir = False
@@ -471,8 +1405,9 @@ class StorageFile(object):
 
     def unlink(self):
         log.info('Unlinking file %s', repr(self.path))
-        self.parent.remove_ls_entry(self.name)
-        self.inode.unlink()
+        with self.parent.storage.operation():
+            self.parent.remove_ls_entry(self.name)
+            self.inode.unlink()
 
 def quote(name):
     return (binascii.b2a_qp(name, quotetabs=True, istext=False)
@@ -491,6 +1426,179 @@ def iter_entries(ls_data):
         name, value = line.rsplit(' ', 1)
         yield unquote(name), value
 
+def format_entries(entries):
+    return ''.join('%s %s\n' % (quote(name), value)
+                   for name, value in entries.iteritems())
+
+# parsed listing buckets, keyed by the git id of their blob
+listing_cache = LRUCache(1000 * 1000) # 1M entries
+
+def bucket_entries(blob):
+    git_id = blob.git_id
+    entries = listing_cache.get(git_id)
+    if entries is None:
+        entries = collections.OrderedDict(iter_entries(blob.data))
+        listing_cache.put(git_id, entries)
+    return entries
+
+def update_bucket(blob, update):
+    """
+    Change a listing bucket by calling `update(entries, blob)`. The parsed
+    entries are taken out of `listing_cache` while being modified, and put
+    back under the blob's new id.
+    """
+    entries = bucket_entries(blob)
+    listing_cache.pop(blob.git_id)
+    with blob as b:
+        update(entries, b)
+    listing_cache.put(blob.git_id, entries)
+    return entries
+
+fsck_chunk_size = 10000 # inodes checked by each fsck task
+
+def fsck(repo_path, out, processes=None):
+    """
+    Check the consistency of a filesystem, writing problems to `out` as
+    they are found. Returns the number of problems.
+
+    Directories are walked in this process, counting references to each
+    inode; then inodes are checked by a pool of worker processes, in
+    chunks of `fsck_chunk_size`. Reference counts are kept in an array,
+    so memory use stays low even with millions of inodes.
+    """
+    eg = EasyGit.open_repo(repo_path)
+    features = FeatureBlob(eg.root['features'])
+    next_inode_number = features['next_inode_number']
+    problems = [0]
+
+    def report(message):
+        problems[0] += 1
+        out.write(message + '\n')
+        out.flush()
+
+    refs = array.array('L', [0]) * next_inode_number
+    dir_count = 0
+    stack = [('/', Listing(eg.root, 'root.ls'), eg.root['root.sub'])]
+    while stack:
+        path, listing, sub_tree = stack.pop()
+        dir_count += 1
+        for name, value in listing.iteritems():
+            if value == '/':
+                qname = quote(name)
+                if _fsck_child(sub_tree, qname + '.ls') is None:
+                    report('%s%s: directory listing is missing' % (path, name))
+                    continue
+                # a missing .sub only matters if there are subfolders
+                child_sub = _fsck_child(sub_tree, qname + '.sub')
+                stack.append( (path + name + '/',
+                               Listing(sub_tree, qname + '.ls'), child_sub) )
+                continue
+
+            try:
+                number = int(value[1:])
+                assert value == 'i%d' % number
+            except (ValueError, AssertionError):
+                report('%s%s: bad inode name %r' % (path, name, value))
+                continue
+            if number >= next_inode_number:
+                report('%s%s: inode %r is past next_inode_number' %
+                       (path, name, value))
+                continue
+            refs[number] += 1
+
+    tasks = ((repo_path, start, refs[start:start + fsck_chunk_size])
+             for start in xrange(0, next_inode_number, fsck_chunk_size))
+    pool = multiprocessing.Pool(processes)
+    try:
+        for messages in pool.imap_unordered(_fsck_inodes, tasks):
+            for message in messages:
+                report(message)
+    finally:
+        pool.terminate()
+
+    out.write('fsck: %d directories, %d inode numbers, %d problems\n' %
+              (dir_count, next_inode_number, problems[0]))
+    return problems[0]
+
+def _fsck_child(tree, name):
+    if tree is None:
+        return None
+    try:
+        return tree[name]
+    except KeyError:
+        return None
+
+def _fsck_inodes(args):
+    """ Check one chunk of inodes, in an `fsck` worker process. """
+    repo_path, start, refs = args
+    eg = EasyGit.open_repo(repo_path)
+    inodes_tt = TreeTree(eg.root['inodes'], prefix='it')
+    meta_table = open_meta_table(eg)
+    messages = []
+
+    for number, ref_count in enumerate(refs, start):
+        name = 'i%d' % number
+        try:
+            inode_tree = inodes_tt[name[1:]]
+        except KeyError:
+            if ref_count:
+                messages.append('%s: referenced %d times, but missing '
+                                'from the inode index' % (name, ref_count))
+            continue
+
+        if not ref_count:
+            messages.append('%s: orphaned inode, not referenced by any '
+                            'directory' % name)
+        inode = make_inode(name, inode_tree, DummyStorage(), meta_table)
+        try:
+            nlink, size = inode['nlink'], inode['size']
+        except (KeyError, ValueError):
+            messages.append('%s: unreadable metadata' % name)
+            continue
+
+        if ref_count and nlink != ref_count:
+            messages.append('%s: nlink is %d, but it is referenced %d times'
+                            % (name, nlink, ref_count))
+
+        last_block = _fsck_last_block(inode_tree)
+        if last_block is not None:
+            n_block, block_size = last_block
+            block_end = n_block * inode.blocksize + block_size
+            if block_end > size:
+                messages.append('%s: size is %d, but block %d ends at %d'
+                                % (name, size, n_block, block_end))
+
+        if isinstance(inode, ChunkedInode):
+            inode._load_index()
+            if inode._stored_end() > size:
+                messages.append('%s: size is %d, but chunks end at %d'
+                                % (name, size, inode._stored_end()))
+
+        inline_blob = inode._inline_blob()
+        if inline_blob is not None and len(inline_blob.data) > size:
+            messages.append('%s: size is %d, but inline data is %d bytes'
+                            % (name, size, len(inline_blob.data)))
+
+    return messages
+
+def _fsck_last_block(inode_tree):
+    """ Find the highest-numbered block of an inode and its size. """
+    lengths = [int(key[2:]) for key in inode_tree.keys()
+               if key.startswith('bt') and key[2:].isdigit()]
+    if not lengths:
+        return None
+
+    length = max(lengths)
+    node = inode_tree['bt%d' % length]
+    digits = ''
+    for c in range(length):
+        if not node.keys():
+            return None
+        digit = max(node.keys())
+        digits += digit
+        node = node[digit]
+    return int(digits), len(node.data)
+
 upgrade_log = logging.getLogger('spaghettifs.storage.upgrade')
 upgrade_log.setLevel(logging.DEBUG)
 
@@ -532,6 +1640,15 @@ def storage_format_upgrade(upgrade_name, upgrade_from, upgrade_to):
 
     return decorator
 
+class DummyStorage(object):
+    """ Stands in for `GitStorage` when inodes are used offline. """
+    lock = threading.RLock()
+    inline_max_size = 0
+    def _autocommit(self): pass
+    def _inode_dirty(self, inode, nbytes=0): pass
+    def _inode_flushed(self, inode, nbytes): pass
+    def _dirty_dropped(self, nbytes): pass
+
 @storage_format_upgrade('Convert inode blocks list to treetree',
                        upgrade_from={'inode_format': None},
                        upgrade_to={'inode_format': 'treetree'})
@@ -542,9 +1659,6 @@ def convert_fs_to_treetree_inodes(eg):
     """
 
     inode_index = eg.root['inodes']
-
-    class DummyStorage(object):
-        def _autocommit(self): pass
     s = DummyStorage()
 
     for inode_name in inode_index:
@@ -559,12 +1673,13 @@ def convert_fs_to_treetree_inodes(eg):
 
         for block_offset in sorted(block_offsets):
             old_block_name = 'b%d' % block_offset
-            new_block_name = str(block_offset / StorageInode.blocksize)
+            new_block_name = str(block_offset / StorageInode.default_blocksize)
             old_block = inode.tree[old_block_name]
             new_block = inode.tt.clone(old_block, new_block_name)
             del inode.tree[old_block_name]
 
         inode['size'] = block_offset + len(new_block.data)
+        inode.flush()
         inode.tree._commit()
 
 @storage_format_upgrade('Convert list of inodes to treetree',
@@ -590,7 +1705,62 @@ def convert_fs_to_treetree_inode_index(eg):
 
     FeatureBlob(eg.root['features'])['next_inode_number'] = largest_number + 1
 
+@storage_format_upgrade('Shard large directory listings',
+                       upgrade_from={'dir_format': None},
+                       upgrade_to={'dir_format': 'hashed'})
+def convert_fs_to_hashed_listings(eg):
+    """
+    Convert a filesystem from the "flat directory listing" format to the
+    "hashed directory listing" format. Small listings are valid in both
+    formats; large ones are split into buckets.
+    """
+
+    def convert(listing, sub_tree):
+        upgrade_log.debug('Resharding listing %r', listing.name)
+        listing.reshard()
+        if sub_tree is None:
+            return
+        for name, value in listing.iteritems():
+            if value != '/':
+                continue
+            qname = quote(name)
+            try:
+                child_sub = sub_tree[qname + '.sub']
+            except KeyError:
+                child_sub = None
+            convert(Listing(sub_tree, qname + '.ls'), child_sub)
+
+    convert(Listing(eg.root, 'root.ls'), eg.root['root.sub'])
+
+@storage_format_upgrade('Pack inode metadata into tables',
+                       upgrade_from={'inode_meta_format': None},
+                       upgrade_to={'inode_meta_format': 'table'})
+def convert_fs_to_meta_table(eg):
+    """
+    Convert a filesystem from the "text meta blob in each inode" format to
+    the "packed inode meta table" format.
+    """
+
+    inodes_tt = TreeTree(eg.root['inodes'], prefix='it')
+    meta_table = InodeMetaTable(eg.root)
+    next_inode_number = FeatureBlob(eg.root['features'])['next_inode_number']
+
+    for number in xrange(next_inode_number):
+        try:
+            inode_tree = inodes_tt[str(number)]
+        except KeyError:
+            continue
+        upgrade_log.debug('Moving metadata of inode %r to table', number)
+        inode = StorageInode('i%d' % number, inode_tree, DummyStorage())
+        meta = inode._load_meta()
+        inode.meta_table = meta_table
+        inode._write_meta(meta)
+        if 'meta' in inode_tree:
+            del inode_tree['meta']
+
 all_updates = [
     convert_fs_to_treetree_inodes,
     convert_fs_to_treetree_inode_index,
+    convert_fs_to_hashed_listings,
+    convert_fs_to_meta_table,
 ]
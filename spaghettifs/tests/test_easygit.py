@@ -2,11 +2,13 @@ import unittest
 import tempfile
 import shutil
 import os
+import threading
 from time import time
 
 import dulwich
 from support import setup_logger
-from spaghettifs.easygit import EasyGit
+from spaghettifs.easygit import EasyGit, LRUCache
+from spaghettifs import easygit
 
 class BasicTestCase(unittest.TestCase):
     def setUp(self):
@@ -324,6 +326,294 @@ class ContextTestCase(unittest.TestCase):
         b = r.new_blob('b')
         b.data = 'asdf'
 
+class PackTestCase(unittest.TestCase):
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.eg = EasyGit.new_repo(self.repo_path, bare=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def list_objects(self):
+        objects_path = os.path.join(self.repo_path, 'objects')
+        loose = []
+        for name in os.listdir(objects_path):
+            if name in ('pack', 'info'):
+                continue
+            loose.extend(os.listdir(os.path.join(objects_path, name)))
+        packs = [name for name in
+                 os.listdir(os.path.join(objects_path, 'pack'))
+                 if name.endswith('.pack')]
+        return loose, packs
+
+    def test_commit_writes_one_pack(self):
+        self.eg.git.object_store.min_pack_objects = 1
+        with self.eg.root as r:
+            r.new_blob('b1').data = 'asdf'
+            with r.new_tree('t') as t:
+                t.new_blob('b2').data = 'qwer'
+        self.assertEqual(self.list_objects(), ([], []))
+
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="packed commit")
+        loose, packs = self.list_objects()
+        self.assertEqual(loose, [])
+        self.assertEqual(len(packs), 1)
+
+        eg2 = EasyGit.open_repo(self.repo_path)
+        self.assertEqual(eg2.root['b1'].data, 'asdf')
+        self.assertEqual(eg2.root['t']['b2'].data, 'qwer')
+
+    def test_pack_index(self):
+        self.eg.git.object_store.min_pack_objects = 1
+        with self.eg.root as r:
+            for c in range(50):
+                r.new_blob('b%d' % c).data = 'blob %d' % c * 1000
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="packed commit")
+        loose, packs = self.list_objects()
+        pack_path = os.path.join(self.repo_path, 'objects', 'pack', packs[0])
+
+        pack = dulwich.pack.Pack(pack_path[:-len('.pack')])
+        pack.check()
+        for git_id in pack:
+            self.assertEqual(pack[git_id].id, git_id)
+        eg2 = EasyGit.open_repo(self.repo_path)
+        for c in range(50):
+            self.assertEqual(eg2.root['b%d' % c].data, 'blob %d' % c * 1000)
+
+    def test_parallel_commit(self):
+        self.eg.git.object_store.min_pack_objects = 1
+        pool_size = easygit.pool_size
+        easygit.pool_size = 4
+        try:
+            with self.eg.root as r:
+                for c in range(20):
+                    with r.new_tree('t%d' % c) as t:
+                        t.new_blob('b').data = 'blob %d' % c * 10000
+            self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                           message="parallel commit")
+        finally:
+            easygit.pool_size = pool_size
+
+        eg2 = EasyGit.open_repo(self.repo_path)
+        for c in range(20):
+            self.assertEqual(eg2.root['t%d' % c]['b'].data,
+                             'blob %d' % c * 10000)
+
+    def test_reads_outside_lock(self):
+        object_store = self.eg.git.object_store
+        object_store.min_pack_objects = 1
+        with self.eg.root as r:
+            for c in range(50):
+                r.new_blob('b%d' % c).data = 'blob %d' % c * 1000
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="packed commit")
+        git_ids = [self.eg.root['b%d' % c].git_id for c in range(50)]
+        errors = []
+
+        def read_all():
+            try:
+                for c, git_id in enumerate(git_ids):
+                    assert object_store[git_id].data == 'blob %d' % c * 1000
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=read_all) for c in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # the underlying store is read without holding the lock
+        reader = object_store._reader()
+        class CheckingReader(object):
+            def __getitem__(self, git_id):
+                assert not object_store._lock.locked()
+                return reader[git_id]
+        object_store._reader = CheckingReader
+        self.assertEqual(object_store[git_ids[0]].data, 'blob 0' * 1000)
+        del object_store._reader
+
+        # a thread's reader picks up packs written after it was opened
+        with self.eg.root as r:
+            r.new_blob('new').data = 'new blob'
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="second pack")
+        new_id = self.eg.root['new'].git_id
+        self.assertEqual(object_store[new_id].data, 'new blob')
+
+    def test_clean_trees_not_rewritten(self):
+        with self.eg.root as r:
+            r.new_tree('t1').new_blob('b').data = 'one'
+            r.new_tree('t2').new_blob('b').data = 'two'
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="first")
+        object_store = self.eg.git.object_store
+        written = object_store.objects_written
+
+        self.eg.root['t1']['b'].data = 'changed'
+        self.eg.root['t2']['b'].data = 'two'
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="second")
+        # blob, t1 and the root tree, plus the commit
+        self.assertEqual(object_store.objects_written - written, 4)
+
+    def test_small_commit_stays_loose(self):
+        self.eg.root.new_blob('b1').data = 'asdf'
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="loose commit")
+        loose, packs = self.list_objects()
+        self.assertEqual(packs, [])
+        self.assertNotEqual(loose, [])
+
+    def test_large_commit_is_packed(self):
+        self.eg.git.object_store.min_pack_bytes = 10000
+        self.eg.root.new_blob('b1').data = 'x' * 20000
+        self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                       message="large commit")
+        loose, packs = self.list_objects()
+        self.assertEqual(loose, [])
+        self.assertEqual(len(packs), 1)
+
+    def test_small_packs_merged(self):
+        object_store = self.eg.git.object_store
+        object_store.min_pack_objects = 1
+        object_store.max_small_packs = 2
+        git_ids = []
+        for c in range(5):
+            self.eg.root.new_blob('b%d' % c).data = 'blob %d' % c
+            self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                           message="commit %d" % c)
+            git_ids.append(self.eg.root['b%d' % c].git_id)
+            # this thread's store knows of packs that get merged
+            self.assertEqual(object_store[git_ids[0]].data, 'blob 0')
+            loose, packs = self.list_objects()
+            self.assertTrue(len(packs) <= 2)
+
+        for c, git_id in enumerate(git_ids):
+            self.assertEqual(object_store[git_id].data, 'blob %d' % c)
+        eg2 = EasyGit.open_repo(self.repo_path)
+        for c in range(5):
+            self.assertEqual(eg2.root['b%d' % c].data, 'blob %d' % c)
+
+    def fsynced_paths(self, func):
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('needs /proc/self/fd')
+        paths = []
+        real_fsync = os.fsync
+        def fsync(fd):
+            paths.append(os.readlink('/proc/self/fd/%d' % fd))
+            real_fsync(fd)
+        os.fsync = fsync
+        try:
+            func()
+        finally:
+            os.fsync = real_fsync
+        return paths
+
+    def test_commit_is_durable(self):
+        objects_path = os.path.realpath(os.path.join(self.repo_path,
+                                                     'objects'))
+        def commit():
+            self.eg.root.new_blob('b1').data = 'asdf'
+            self.eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                           message="loose commit")
+        def loose_paths():
+            return set(os.path.join(objects_path, name, rest)
+                       for name in os.listdir(objects_path)
+                       if name not in ('pack', 'info')
+                       for rest in os.listdir(os.path.join(objects_path,
+                                                           name)))
+        old_loose = loose_paths()
+        paths = self.fsynced_paths(commit)
+        new_loose = loose_paths() - old_loose
+        self.assertNotEqual(new_loose, set())
+        for path in new_loose:
+            self.assertTrue(path + '.lock' in paths)
+            self.assertTrue(os.path.dirname(path) in paths)
+        self.assertTrue(objects_path in paths)
+        heads_path = os.path.realpath(os.path.join(self.repo_path,
+                                                   'refs', 'heads'))
+        self.assertTrue(os.path.join(heads_path, 'master') in paths)
+        self.assertTrue(heads_path in paths)
+
+        self.eg.git.object_store.min_pack_objects = 1
+        paths = self.fsynced_paths(commit)
+        pack_path = os.path.join(objects_path, 'pack')
+        idx_paths = [path for path in paths
+                     if path.startswith(pack_path + '/pack-')]
+        self.assertEqual([path[-len('.idx.lock'):] for path in idx_paths],
+                         ['.idx.lock'])
+        self.assertTrue(pack_path in paths)
+
+    def test_read_before_commit(self):
+        r = self.eg.root
+        b = r.new_blob('b')
+        b.data = 'asdf'
+        r.clone(r.new_tree('t'), 'u')
+        b2 = r['t'].clone(b, 'b2')
+        self.assertEqual(b2.data, 'asdf')
+        self.assertEqual(r['u'].keys(), [])
+
+class LRUCacheTestCase(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = LRUCache(10)
+        cache.put('a', 'xxxx')
+        cache.put('b', 'yyyy')
+        self.assertEqual(cache.get('a'), 'xxxx')
+        cache.put('c', 'zzzz')
+        self.assertEqual(cache.size, 8)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'xxxx')
+        self.assertEqual(cache.get('c'), 'zzzz')
+        self.assertEqual(cache.hits, 3)
+        self.assertEqual(cache.misses, 1)
+
+    def test_too_large(self):
+        cache = LRUCache(10)
+        cache.put('a', 'x' * 11)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.size, 0)
+
+    def test_blob_reads_use_cache(self):
+        repo_path = tempfile.mkdtemp()
+        try:
+            eg = EasyGit.new_repo(repo_path, bare=True)
+            eg.root.new_blob('b').data = 'cached data'
+            eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                      message="blob cache test")
+
+            eg2 = EasyGit.open_repo(repo_path)
+            hits = easygit.blob_cache.hits
+            self.assertEqual(eg2.root['b'].data, 'cached data')
+            self.assertEqual(easygit.blob_cache.hits, hits + 1)
+        finally:
+            shutil.rmtree(repo_path)
+
+    def test_shared_trees_copy_on_write(self):
+        repo_path = tempfile.mkdtemp()
+        try:
+            eg = EasyGit.new_repo(repo_path, bare=True)
+            eg.root.new_tree('t').new_blob('b').data = 'tree data'
+            eg.commit(author="Spaghetti User <noreply@grep.ro>",
+                      message="tree cache test")
+
+            eg2 = EasyGit.open_repo(repo_path)
+            eg3 = EasyGit.open_repo(repo_path)
+            hits = easygit.tree_cache.hits
+            t2, t3 = eg2.root['t'], eg3.root['t']
+            self.assertTrue(easygit.tree_cache.hits >= hits + 2)
+            self.assertTrue(t2._git_tree is t3._git_tree)
+
+            t2.new_blob('c').data = 'more data'
+            t2._commit()
+            self.assertEqual(set(t2.keys()), set(['b', 'c']))
+            self.assertEqual(set(t3.keys()), set(['b']))
+        finally:
+            shutil.rmtree(repo_path)
+
 class BranchTestCase(unittest.TestCase):
     def setUp(self):
         self.repo_path = tempfile.mkdtemp()
@@ -207,6 +207,300 @@ class BasicFilesystemOps(SpaghettiMountTestCase):
         else:
             self.fail('OSError not raised')
 
+class DentryCacheTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(DentryCacheTestCase, self).setUp()
+        from spaghettifs.filesystem import SpaghettiFS
+        from spaghettifs.storage import GitStorage
+        self.fs = SpaghettiFS(GitStorage(self.repo_path))
+
+    def test_lookup_hits_cache(self):
+        obj = self.fs.get_obj('/b/c/d.txt')
+        self.assertEqual(obj.read_data(0, 100), 'file D!\n')
+        misses = self.fs.dentries.misses
+        self.assertTrue(self.fs.get_obj('/b/c/d.txt') is obj)
+        self.assertTrue(self.fs.get_obj('/b/c/') is self.fs.get_obj('/b/c'))
+        self.assertEqual(self.fs.dentries.misses, misses)
+
+    def test_negative_entry(self):
+        self.assertTrue(self.fs.get_obj('/b/nothere') is None)
+        hits = self.fs.dentries.hits
+        self.assertTrue(self.fs.get_obj('/b/nothere') is None)
+        self.assertEqual(self.fs.dentries.hits, hits + 1)
+        self.assertTrue(self.fs.get_obj('/b/nothere/deeper') is None)
+
+    def test_invalidate_on_create_and_unlink(self):
+        self.assertTrue(self.fs.get_obj('/b/new.txt') is None)
+        self.fs.create('/b/new.txt', 0644)
+        self.assertFalse(self.fs.get_obj('/b/new.txt') is None)
+        self.fs.unlink('/b/new.txt')
+        self.assertTrue(self.fs.get_obj('/b/new.txt') is None)
+
+    def test_invalidate_on_rename(self):
+        self.fs.get_obj('/b/g.txt')
+        self.fs.rename('/a.txt', '/b/g.txt')
+        self.assertTrue(self.fs.get_obj('/a.txt') is None)
+        self.assertEqual(self.fs.get_obj('/b/g.txt').read_data(0, 100),
+                         'text file "a"\n')
+
+    def test_rmdir_invalidates_subtree(self):
+        self.fs.mkdir('/x', 0755)
+        self.fs.mkdir('/x/y', 0755)
+        self.assertTrue(self.fs.get_obj('/x/y/z') is None)
+        self.fs.rmdir('/x/y')
+        self.fs.rmdir('/x')
+        self.assertTrue(self.fs.get_obj('/x') is None)
+        self.assertTrue(self.fs.get_obj('/x/y') is None)
+        self.fs.mkdir('/x', 0755)
+        self.assertTrue(self.fs.get_obj('/x/y') is None)
+
+    def test_lru_eviction(self):
+        from spaghettifs.filesystem import DentryCache
+        cache = DentryCache(2)
+        cache.store('/a', 1)
+        cache.store('/b', 2)
+        cache.lookup('/a')
+        cache.store('/c', 3)
+        self.assertRaises(KeyError, cache.lookup, '/b')
+        self.assertEqual(cache.lookup('/a'), 1)
+        self.assertEqual(cache.stats()['count'], 2)
+
+class FileHandleTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(FileHandleTestCase, self).setUp()
+        from spaghettifs.filesystem import SpaghettiFS
+        from spaghettifs.storage import GitStorage
+        self.fs = SpaghettiFS(GitStorage(self.repo_path))
+
+    def test_io_through_handle(self):
+        fh = self.fs.open('/b/f.txt', os.O_RDWR)
+        lookups = self.fs.dentries.stats()
+        self.assertEqual(self.fs.write('/b/f.txt', 'G', 0, fh), 1)
+        self.assertEqual(self.fs.read('/b/f.txt', 100, 0, fh), 'G is here\n')
+        self.fs.truncate('/b/f.txt', 4, fh)
+        self.assertEqual(self.fs.read('/b/f.txt', 100, 0, fh), 'G is')
+        self.assertEqual(self.fs.dentries.stats(), lookups)
+        self.fs.release('/b/f.txt', fh)
+        self.assertEqual(self.fs._handles, {})
+        self.assertEqual(self.fs.get_obj('/b/f.txt').read_data(0, 100),
+                         'G is')
+
+    def test_create_returns_handle(self):
+        fh = self.fs.create('/new.txt', 0644)
+        self.fs.write('/new.txt', 'hello', 0, fh)
+        self.fs.release('/new.txt', fh)
+        fh2 = self.fs.open('/new.txt', os.O_RDONLY)
+        self.assertNotEqual(fh, fh2)
+        self.assertEqual(self.fs.read('/new.txt', 100, 0, fh2), 'hello')
+
+    def test_write_after_unlink(self):
+        from cStringIO import StringIO
+        from spaghettifs.storage import fsck
+        fh = self.fs.open('/b/f.txt', os.O_RDWR)
+        self.fs.unlink('/b/f.txt')
+        self.assertEqual(self.fs.write('/b/f.txt', 'G', 0, fh), 1)
+        self.fs.truncate('/b/f.txt', 4, fh)
+        self.fs.flush('/b/f.txt', fh)
+        self.fs.release('/b/f.txt', fh)
+        self.fs.repo.commit('unlinked while open')
+        out = StringIO()
+        self.assertEqual(fsck(self.repo_path, out), 0, out.getvalue())
+
+    def test_open_missing(self):
+        from errno import ENOENT, EISDIR
+        for path, errno in [('/nothere', ENOENT), ('/b', EISDIR)]:
+            try:
+                self.fs.open(path, os.O_RDONLY)
+            except OSError, e:
+                self.assertEqual(e.errno, errno)
+            else:
+                self.fail('OSError not raised')
+
+class GetattrTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(GetattrTestCase, self).setUp()
+        from spaghettifs.filesystem import SpaghettiFS
+        from spaghettifs.storage import GitStorage
+        self.fs = SpaghettiFS(GitStorage(self.repo_path))
+
+    def test_stable_attributes(self):
+        st = self.fs.getattr('/b/f.txt')
+        self.assertEqual(st['st_ino'], 4)
+        self.assertEqual(st['st_size'], 10)
+        time.sleep(.01)
+        self.assertEqual(self.fs.getattr('/b/f.txt'), st)
+        self.assertEqual(self.fs.getattr('/b'), self.fs.getattr('/b/'))
+        self.assertNotEqual(self.fs.getattr('/b')['st_ino'],
+                            self.fs.getattr('/b/c')['st_ino'])
+
+    def test_directory_inodes(self):
+        from spaghettifs.filesystem import DIR_INO_BASE
+        for c in range(100):
+            self.fs.mkdir('/b/c/d%d' % c, 0755)
+        paths = ['/', '/b', '/b/c'] + ['/b/c/d%d' % c for c in range(100)]
+        inos = [self.fs.getattr(path)['st_ino'] for path in paths]
+        self.assertEqual(len(set(inos)), len(paths))
+        self.assertTrue(min(inos) >= DIR_INO_BASE)
+        self.assertEqual([self.fs.getattr(path)['st_ino'] for path in paths],
+                         inos)
+
+    def test_write_updates_mtime(self):
+        fh = self.fs.open('/b/f.txt', os.O_RDWR)
+        self.fs.write('/b/f.txt', 'x', 0, fh)
+        self.fs.release('/b/f.txt', fh)
+        st = self.fs.getattr('/b/f.txt')
+        self.assertTrue(st['st_mtime'] > time.time() - 60)
+        self.assertEqual(st['st_ctime'], st['st_mtime'])
+
+class ConcurrencyTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(ConcurrencyTestCase, self).setUp()
+        from spaghettifs.filesystem import SpaghettiFS
+        from spaghettifs.storage import GitStorage
+        self.repo = GitStorage(self.repo_path, autocommit=False)
+        self.fs = SpaghettiFS(self.repo)
+
+    def test_rwlock(self):
+        import threading
+        from spaghettifs.filesystem import RWLock
+        lock = RWLock()
+        events = []
+
+        def writer():
+            with lock.write():
+                events.append('write')
+
+        with lock.read():
+            with lock.read():
+                t = threading.Thread(target=writer)
+                t.start()
+                time.sleep(.05)
+                self.assertEqual(events, [])
+        t.join()
+        self.assertEqual(events, ['write'])
+
+    def test_parallel_io(self):
+        import threading
+        names = ['/f%d' % n for n in range(4)]
+        for name in names:
+            self.fs('release', name, self.fs('create', name, 0644))
+        chunks = dict((name, randomdata(8 * 1024)) for name in names)
+        errors = []
+
+        def worker(name):
+            try:
+                fh = self.fs('open', name, os.O_RDWR)
+                for n in range(16):
+                    self.fs('write', name, chunks[name], n * 8 * 1024, fh)
+                    self.fs('getattr', '/b/f.txt')
+                    self.fs('read', name, 8 * 1024, n * 8 * 1024, fh)
+                self.fs('release', name, fh)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(name,))
+                   for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+
+        from spaghettifs.storage import GitStorage
+        self.repo.commit('parallel writes')
+        root = GitStorage(self.repo_path).get_root()
+        for name in names:
+            self.assertEqual(root[name[1:]]._read_all_data(),
+                             chunks[name] * 16)
+
+    def test_parallel_lookups(self):
+        import threading
+        from spaghettifs.filesystem import SpaghettiFS
+        from spaghettifs.storage import GitStorage
+        from spaghettifs import easygit, storage
+        names = ['/b/c/f%d' % n for n in range(200)]
+        for name in names:
+            self.fs('release', name, self.fs('create', name, 0644))
+        self.repo.commit('many files')
+        for cache in (easygit.blob_cache, easygit.tree_cache,
+                      storage.listing_cache):
+            cache.clear()
+        fs = SpaghettiFS(GitStorage(self.repo_path, autocommit=False))
+        errors = []
+
+        def worker(n):
+            try:
+                for name in names[n::2] + names[:n:2]:
+                    fs('getattr', name)
+            except Exception, e:
+                errors.append(e)
+
+        # switch threads often, so that lookups interleave
+        check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for c in range(5):
+                # cold dentries; the folders they held are released
+                fs.dentries.invalidate('/', recursive=True)
+                threads = [threading.Thread(target=worker, args=(n % 2,))
+                           for n in range(8)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        finally:
+            sys.setcheckinterval(check_interval)
+        self.assertEqual(errors, [])
+        for name in names:
+            self.assertTrue(fs.get_obj(name) is not None)
+
+class CheckpointerTestCase(SpaghettiTestCase):
+    def open_fs(self, **limits):
+        from spaghettifs.filesystem import _open_fs, SpaghettiFS
+        from spaghettifs.storage import CommitPolicy
+        policy = CommitPolicy(**dict(dict(max_operations=None), **limits))
+        self.opener = _open_fs(self.repo_path, SpaghettiFS, policy)
+        self.fs = self.opener.__enter__()
+        self.fs.checkpointer.poll_interval = .05
+        self.git = self.fs.repo.eg.git
+        return self.git.refs['refs/heads/mounted']
+
+    def tearDown(self):
+        self.opener.__exit__(None, None, None)
+        super(CheckpointerTestCase, self).tearDown()
+
+    def wait_for_checkpoint(self, old_id):
+        for c in xrange(40):
+            if self.git.refs['refs/heads/mounted'] != old_id:
+                return True
+            time.sleep(.05)
+        return False
+
+    def test_operation_limit(self):
+        mounted_id = self.open_fs(max_operations=3)
+        self.fs('mkdir', '/x', 0755)
+        self.fs('mkdir', '/y', 0755)
+        time.sleep(.2)
+        self.assertEqual(self.git.refs['refs/heads/mounted'], mounted_id)
+        self.fs('mkdir', '/z', 0755)
+        self.assertTrue(self.wait_for_checkpoint(mounted_id))
+        tree_id = self.git.commit(self.git.refs['refs/heads/mounted']).tree
+        self.assertNotEqual(tree_id, self.opener.initial_tree_id)
+
+    def test_byte_limit(self):
+        mounted_id = self.open_fs(max_bytes=10000)
+        fh = self.fs('open', '/a.txt', os.O_RDWR)
+        self.fs('write', '/a.txt', 'x' * 5000, 0, fh)
+        time.sleep(.2)
+        self.assertEqual(self.git.refs['refs/heads/mounted'], mounted_id)
+        self.fs('write', '/a.txt', 'x' * 5000, 5000, fh)
+        self.assertTrue(self.wait_for_checkpoint(mounted_id))
+
+    def test_delay_limit(self):
+        mounted_id = self.open_fs(max_delay=.1)
+        self.fs('unlink', '/b/f.txt')
+        self.assertTrue(self.wait_for_checkpoint(mounted_id))
+
 class FilesystemLoggingTestCase(unittest.TestCase):
     def test_custom_repr(self):
         from spaghettifs.filesystem import LogWrap
@@ -0,0 +1,128 @@
+import unittest
+import os
+from os import path
+
+import dulwich
+
+from support import SpaghettiTestCase, randomdata
+from spaghettifs.journal import Journal, read_journal, segment_path
+
+class JournalTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(JournalTestCase, self).setUp()
+        self.journal_path = path.join(self.tmpdir, 'journal')
+
+    def test_read_back(self):
+        self.assertEqual(read_journal(self.journal_path, 'tree-1'), [])
+        journal = Journal(self.journal_path)
+        journal.start('tree-1')
+        journal.append('mkdir', '/x', 0755)
+        segment = journal.start('tree-2')
+        journal.append('write', 'i3', 10, 'asdf')
+        journal.sync()
+
+        self.assertEqual(read_journal(self.journal_path, 'tree-1'),
+                         [('mkdir', '/x', 0755), ('write', 'i3', 10, 'asdf')])
+        self.assertEqual(read_journal(self.journal_path, 'tree-2'),
+                         [('write', 'i3', 10, 'asdf')])
+        self.assertEqual(read_journal(self.journal_path, 'tree-3'), [])
+
+        journal.discard(segment)
+        self.assertEqual(read_journal(self.journal_path, 'tree-1'), [])
+        self.assertEqual(read_journal(self.journal_path, 'tree-2'),
+                         [('write', 'i3', 10, 'asdf')])
+        journal.remove()
+        self.assertEqual(os.listdir(self.tmpdir), ['repo.sfs'])
+
+    def test_torn_record(self):
+        journal = Journal(self.journal_path)
+        segment = journal.start('tree-1')
+        journal.append('unlink', '/a.txt')
+        journal.append('write', 'i3', 0, randomdata(1000))
+
+        with open(segment_path(self.journal_path, segment), 'r+b') as f:
+            f.seek(-10, 2)
+            f.truncate()
+        self.assertEqual(read_journal(self.journal_path, 'tree-1'),
+                         [('unlink', '/a.txt')])
+
+    def test_corrupt_record(self):
+        journal = Journal(self.journal_path)
+        segment = journal.start('tree-1')
+        journal.append('unlink', '/a.txt')
+        journal.append('unlink', '/b/f.txt')
+
+        with open(segment_path(self.journal_path, segment), 'r+b') as f:
+            f.seek(-3, 2)
+            f.write('xxx')
+        self.assertEqual(read_journal(self.journal_path, 'tree-1'),
+                         [('unlink', '/a.txt')])
+
+class RecoveryTestCase(SpaghettiTestCase):
+    def open_fs(self):
+        from spaghettifs.filesystem import _open_fs, SpaghettiFS
+        opener = _open_fs(self.repo_path, SpaghettiFS)
+        return opener, opener.__enter__()
+
+    def write_file(self, fs, file_path, data, offset=0):
+        fh = fs.open(file_path, os.O_RDWR)
+        fs.write(file_path, data, offset, fh)
+        fs.release(file_path, fh)
+
+    def read_file(self, fs, file_path):
+        return fs.get_obj(file_path)._read_all_data()
+
+    def test_replay_after_crash(self):
+        data = randomdata(100000)
+        opener, fs = self.open_fs()
+        fs.release('/new.txt', fs.create('/new.txt', 0644))
+        self.write_file(fs, '/new.txt', data)
+        fs.mkdir('/x', 0755)
+        fs.rename('/a.txt', '/x/a.txt')
+        fs.link('/x/f.txt', '/b/f.txt')
+        fs.unlink('/b/f.txt')
+        self.write_file(fs, '/x/f.txt', 'G', 0)
+        fs.truncate('/b/c/d.txt', 4)
+        # the process dies here, without committing
+
+        opener, fs = self.open_fs()
+        self.assertEqual(self.read_file(fs, '/new.txt'), data)
+        self.assertEqual(self.read_file(fs, '/x/a.txt'), 'text file "a"\n')
+        self.assertEqual(self.read_file(fs, '/x/f.txt'), 'G is here\n')
+        self.assertEqual(self.read_file(fs, '/b/c/d.txt'), 'file')
+        self.assertTrue(fs.get_obj('/a.txt') is None)
+        self.assertTrue(fs.get_obj('/b/f.txt') is None)
+        opener.__exit__(None, None, None)
+
+        git = dulwich.repo.Repo(self.repo_path)
+        self.assertFalse('refs/heads/mounted' in git.refs)
+        self.assertEqual([name for name in os.listdir(self.repo_path)
+                          if name.startswith('spaghettifs.journal')], [])
+        opener, fs = self.open_fs()
+        self.assertEqual(self.read_file(fs, '/new.txt'), data)
+        opener.__exit__(None, None, None)
+
+    def test_replay_after_checkpoint(self):
+        opener, fs = self.open_fs()
+        self.write_file(fs, '/a.txt', 'before')
+        fs.commit_mounted()
+        self.write_file(fs, '/a.txt', 'after', 6)
+        fs.mkdir('/x', 0755)
+
+        opener, fs = self.open_fs()
+        self.assertEqual(self.read_file(fs, '/a.txt'), 'beforeaftera"\n')
+        self.assertTrue(fs.get_obj('/x').is_dir)
+        opener.__exit__(None, None, None)
+
+    def test_stale_journal_ignored(self):
+        opener, fs = self.open_fs()
+        fs.mkdir('/x', 0755)
+        opener.__exit__(None, None, None)
+
+        journal = Journal(opener.journal_path)
+        journal.start('0' * 40)
+        journal.append('rmdir', '/b/c')
+        opener, fs = self.open_fs()
+        self.assertTrue(fs.get_obj('/b/c').is_dir)
+        self.assertTrue(fs.get_obj('/x').is_dir)
+        opener.__exit__(None, None, None)
@@ -4,12 +4,15 @@ import tempfile
 import shutil
 import random
 import json
+from cStringIO import StringIO
 
 import dulwich
 
 from support import SpaghettiTestCase, setup_logger, randomdata
-from spaghettifs.storage import GitStorage, FeatureBlob
+from spaghettifs.storage import GitStorage, FeatureBlob, CommitPolicy
 from spaghettifs import treetree
+from spaghettifs import storage
+from spaghettifs import easygit
 
 class BackendTestCase(SpaghettiTestCase):
     def test_walk(self):
@@ -230,6 +233,140 @@ class BackendTestCase(SpaghettiTestCase):
         self.assertFalse(inode_name in self.repo.eg.root['inodes'])
         self.assertRaises(KeyError, self.repo.get_inode, inode_name)
 
+class LazySubTreeTestCase(SpaghettiTestCase):
+    def head(self):
+        return dulwich.repo.Repo(self.repo_path).head()
+
+    def test_read_without_subfolders(self):
+        self.repo.autocommit = False
+        head_0 = self.head()
+        object_store = self.repo.eg.git.object_store
+        c = self.repo.get_root()['b']['c']
+        self.assertEqual(set(c.keys()), set(['d.txt', 'e.txt']))
+        self.assertEqual(c['d.txt']._read_all_data(), 'file D!\n')
+        self.repo.commit('nothing')
+        self.assertEqual(self.head(), head_0)
+        self.assertEqual(object_store.objects_written, 0)
+        b_sub = self.repo.eg.root['root.sub']['b.sub']
+        self.assertRaises(KeyError, lambda: b_sub['c.sub'])
+
+        c.create_directory('x').create_directory('y')
+        self.repo.get_root()['b']['c'].create_directory('z')
+        self.repo.commit('subfolders')
+        c = GitStorage(self.repo_path).get_root()['b']['c']
+        self.assertEqual(set(c.keys()), set(['d.txt', 'e.txt', 'x', 'z']))
+        self.assertEqual(set(c['x'].keys()), set(['y']))
+
+        c['x'].unlink()
+        c['z'].unlink()
+        self.assertEqual(set(c.keys()), set(['d.txt', 'e.txt']))
+
+    def test_lookup_without_sub_tree(self):
+        c = self.repo.get_root()['b']['c']
+        self.assertTrue(c.sub_tree is None)
+        # a broken listing that names a subfolder that was never made
+        c.listing.add('x', '/')
+
+        sub_tree_calls = []
+        def get_sub_tree(create=False):
+            sub_tree_calls.append(create)
+            return storage.StorageDir._get_sub_tree(c, create)
+        c._get_sub_tree = get_sub_tree
+        listing_containers = []
+        def listing(container, name):
+            listing_containers.append(container)
+            return GitStorage._listing(self.repo, container, name)
+        self.repo._listing = listing
+
+        self.assertRaises(KeyError, lambda: c['x'])
+        self.assertEqual(sub_tree_calls, [False])
+        self.assertEqual(listing_containers, [])
+        self.assertTrue(c.sub_tree is None)
+
+class DirectoryListingTestCase(SpaghettiTestCase):
+    def test_lookups_use_listing_cache(self):
+        c = self.repo.get_root()['b']['c']
+        c['d.txt']
+        hits = storage.listing_cache.hits
+        c['e.txt']
+        self.assertTrue('d.txt' in c)
+        self.assertFalse('x.txt' in c)
+        self.assertEqual(storage.listing_cache.hits, hits + 3)
+
+    def test_listing_updates(self):
+        c = self.repo.get_root()['b']['c']
+        c.create_file('x.txt')
+        c.create_directory('y')
+        c['d.txt'].unlink()
+        self.assertEqual(list(c.keys()), ['e.txt', 'x.txt', 'y'])
+        c_ls = self.repo.eg.root['root.sub']['b.sub']['c.ls']
+        self.assertEqual(c_ls.data, 'e.txt i3\nx.txt i5\ny /\n')
+
+        repo2 = GitStorage(self.repo_path)
+        c_2 = repo2.get_root()['b']['c']
+        self.assertEqual(list(c_2.keys()), ['e.txt', 'x.txt', 'y'])
+
+    def test_identical_listings(self):
+        b = self.repo.get_root()['b']
+        x = b.create_directory('x')
+        y = b.create_directory('y')
+        self.assertEqual(list(y.keys()), [])
+        x.create_file('f')
+        self.assertEqual(list(x.keys()), ['f'])
+        self.assertEqual(list(y.keys()), [])
+
+class HashedListingTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(HashedListingTestCase, self).setUp()
+        self._orig_max = storage.Listing.max_bucket_entries
+        storage.Listing.max_bucket_entries = 4
+
+    def tearDown(self):
+        storage.Listing.max_bucket_entries = self._orig_max
+        super(HashedListingTestCase, self).tearDown()
+
+    def test_split_buckets(self):
+        FeatureBlob(self.repo.eg.root['features'])['dir_format'] = 'hashed'
+        self.repo.commit('use hashed listings')
+        self.repo = GitStorage(self.repo_path)
+
+        g = self.repo.get_root()['b'].create_directory('g')
+        names = ['f_%d' % c for c in range(40)]
+        for name in names:
+            g.create_file(name)
+
+        g_ls = self.repo.eg.root['root.sub']['b.sub']['g.ls']
+        self.assertTrue(g_ls.is_tree)
+        self.assertEqual(set(g_ls.keys()), set('0123456789abcdef'))
+
+        repo2 = GitStorage(self.repo_path)
+        g_2 = repo2.get_root()['b']['g']
+        self.assertEqual(set(g_2.keys()), set(names))
+        for name in names[::3]:
+            g_2[name].unlink()
+        self.assertEqual(set(g_2.keys()), set(names) - set(names[::3]))
+        self.assertFalse(names[0] in g_2)
+        self.assertTrue(names[1] in g_2)
+
+    def test_upgrade(self):
+        flat_repo = self.repo
+        g = flat_repo.get_root()['b'].create_directory('g')
+        names = ['f_%d' % c for c in range(20)]
+        for name in names:
+            g.create_file(name)
+        g_ls = flat_repo.eg.root['root.sub']['b.sub']['g.ls']
+        self.assertFalse(g_ls.is_tree)
+
+        storage.convert_fs_to_hashed_listings(self.repo_path)
+
+        repo2 = GitStorage(self.repo_path)
+        self.assertEqual(repo2.dir_format, 'hashed')
+        g_ls = repo2.eg.root['root.sub']['b.sub']['g.ls']
+        self.assertTrue(g_ls.is_tree)
+        self.assertEqual(set(repo2.get_root()['b']['g'].keys()), set(names))
+        self.assertEqual(set(repo2.get_root()['b']['c'].keys()),
+                         set(['d.txt', 'e.txt']))
+
 class LargeFileTestCase(SpaghettiTestCase):
     large_data = randomdata(1024 * 1024) # 1 MB
 
@@ -355,6 +492,325 @@ class LargeFileTestCase(SpaghettiTestCase):
         self.assert_file_contents('_' * (3*kb64-1) + 'xy' + '_' * (7*kb64-1))
         f.unlink()
 
+class WriteBufferTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(WriteBufferTestCase, self).setUp()
+        self.repo.autocommit = False
+
+    def git_blocks(self, inode):
+        return sorted(int(name) for name in ['0', '1', '2', '3']
+                      if name in inode.tt)
+
+    def test_writes_are_buffered(self):
+        f = self.repo.get_root()['b'].create_file('f')
+        for offset in range(0, 100 * 1024, 4096):
+            f.write_data('x' * 4096, offset)
+        self.assertEqual(self.git_blocks(f.inode), [])
+        self.assertEqual(f.inode._read_meta()['size'], '0')
+        self.assertEqual(f.size, 100 * 1024)
+        self.assertEqual(f._read_all_data(), 'x' * 100 * 1024)
+
+        self.repo.commit('flush buffers')
+        self.assertEqual(self.git_blocks(f.inode), [0, 1])
+        self.assertEqual(f.inode._read_meta()['size'], str(100 * 1024))
+
+        repo2 = GitStorage(self.repo_path)
+        f_2 = repo2.get_root()['b']['f']
+        self.assertEqual(f_2._read_all_data(), 'x' * 100 * 1024)
+
+    def test_memory_pressure(self):
+        self.repo.max_dirty_bytes = 2 * 64 * 1024
+        f = self.repo.get_root()['b'].create_file('f')
+        f.write_data('y' * 64 * 1024 * 3, 0)
+        self.assertEqual(self.git_blocks(f.inode), [0, 1])
+        self.assertEqual(f._read_all_data(), 'y' * 64 * 1024 * 3)
+
+    def test_truncate_buffered(self):
+        f = self.repo.get_root()['b'].create_file('f')
+        f.write_data('z' * 200 * 1024, 0)
+        f.truncate(70 * 1024)
+        self.assertEqual(f._read_all_data(), 'z' * 70 * 1024)
+        f.inode.flush()
+        self.assertEqual(self.git_blocks(f.inode), [0, 1])
+        self.assertEqual(f._read_all_data(), 'z' * 70 * 1024)
+
+    def test_truncate_releases_buffers(self):
+        f = self.repo.get_root()['b'].create_file('f')
+        for c in range(10):
+            f.write_data('z' * 128 * 1024, 0)
+            f.truncate(0)
+        self.assertEqual(self.repo._dirty_bytes, 0)
+        f.write_data('z' * 200 * 1024, 0)
+        f.truncate(70 * 1024)
+        self.assertEqual(self.repo._dirty_bytes, 2 * 64 * 1024)
+        self.repo.commit('truncated')
+        self.assertEqual(self.repo._dirty_bytes, 0)
+        self.assertEqual(self.repo._dirty_inodes, {})
+
+class SparseFileTestCase(SpaghettiTestCase):
+    def git_blocks(self, f):
+        f.inode.flush()
+        return [n for n in range(8) if str(n) in f.inode.tt]
+
+    def test_truncate_extend(self):
+        f = self.repo.get_root()['b'].create_file('f')
+        f.write_data('data', 0)
+        f.truncate(10 * 1024 ** 3) # 10 GB
+        self.assertEqual(f.size, 10 * 1024 ** 3)
+        self.assertEqual(self.git_blocks(f), [0])
+        self.assertEqual(f.read_data(0, 8), 'data\0\0\0\0')
+        self.assertEqual(f.read_data(5 * 1024 ** 3, 100 * 1024),
+                         '\0' * 100 * 1024)
+        self.assertEqual(f.read_data(10 * 1024 ** 3 - 3, 10), '\0' * 3)
+
+    def test_write_past_eof(self):
+        kb64 = 64 * 1024
+        f = self.repo.get_root()['b'].create_file('f')
+        f.write_data('ab', 0)
+        f.write_data('xy', 3 * kb64 + 10)
+        self.assertEqual(self.git_blocks(f), [0, 3])
+        expected = 'ab' + '\0' * (3 * kb64 + 8) + 'xy'
+        self.assertEqual(f._read_all_data(), expected)
+
+        repo2 = GitStorage(self.repo_path)
+        f_2 = repo2.get_root()['b']['f']
+        self.assertEqual(f_2._read_all_data(), expected)
+
+    def test_shrink_then_extend(self):
+        f = self.repo.get_root()['b'].create_file('f')
+        f.write_data('q' * 100, 0)
+        f.truncate(10)
+        f.truncate(20)
+        self.assertEqual(f._read_all_data(), 'q' * 10 + '\0' * 10)
+
+class ReadAheadTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(ReadAheadTestCase, self).setUp()
+        f = self.repo.get_root()['b'].create_file('f')
+        f.write_data(randomdata(10 * 64 * 1024), 0)
+        easygit.blob_cache.clear()
+        self.inode = GitStorage(self.repo_path).get_root()['b']['f'].inode
+
+    def cached_blocks(self):
+        easygit.blob_prefetcher.wait()
+        return [n for n in range(10)
+                if self.inode.tt[str(n)]._git_id in easygit.blob_cache]
+
+    def test_sequential_reads(self):
+        self.inode.read_data(0, 4096)
+        self.assertEqual(self.cached_blocks(), [0, 1, 2, 3, 4])
+        self.inode.read_data(4096, 4096)
+        self.assertEqual(self.cached_blocks(), range(9))
+        self.inode.read_data(8192, 4096)
+        self.assertEqual(self.cached_blocks(), range(10))
+
+    def test_random_reads(self):
+        self.inode.read_data(5 * 64 * 1024, 4096)
+        self.inode.read_data(2 * 64 * 1024, 4096)
+        self.assertEqual(self.cached_blocks(), [2, 5])
+
+class BlockSizeTestCase(SpaghettiTestCase):
+    def block_names(self, inode):
+        return sorted(int(name) for name in map(str, range(200))
+                      if name in inode.tt)
+
+    def test_existing_inodes(self):
+        a = self.repo.get_root()['a.txt']
+        self.assertEqual(a.inode.blocksize, 64 * 1024)
+        self.assertEqual(a._read_all_data(), 'text file "a"\n')
+
+    def test_size_hint(self):
+        b = self.repo.get_root()['b']
+        f = b.create_file('f', size_hint=300 * 1024 * 1024)
+        self.assertEqual(f.inode.blocksize, 4 * 1024 * 1024)
+        data = randomdata(5 * 1024 * 1024)
+        f.write_data(data, 0)
+        self.repo.commit('large blocks')
+        self.assertEqual(self.block_names(f.inode), [0, 1])
+
+        f_2 = GitStorage(self.repo_path).get_root()['b']['f']
+        self.assertEqual(f_2.inode.blocksize, 4 * 1024 * 1024)
+        self.assertEqual(f_2.read_data(4 * 1024 * 1024 - 10, 20),
+                         data[4 * 1024 * 1024 - 10:4 * 1024 * 1024 + 10])
+
+    def test_truncate_hint(self):
+        f = self.repo.get_root()['b'].create_file('f')
+        self.assertEqual(f.inode.blocksize, 64 * 1024)
+        f.truncate(32 * 1024 * 1024)
+        self.assertEqual(f.inode.blocksize, 1024 * 1024)
+        f.write_data('x', 1024 * 1024)
+        self.assertEqual(self.block_names(f.inode), [1])
+
+    def test_default_from_features(self):
+        repo_path = path.join(self.tmpdir, 'small.sfs')
+        repo = GitStorage.create(repo_path, default_blocksize=16 * 1024)
+        f = repo.get_root().create_file('f')
+        data = randomdata(100 * 1024)
+        f.write_data(data, 0)
+        repo.commit('small blocks')
+        self.assertEqual(self.block_names(f.inode), range(7))
+
+        f_2 = GitStorage(repo_path).get_root()['f']
+        self.assertEqual(f_2.inode.blocksize, 16 * 1024)
+        self.assertEqual(f_2._read_all_data(), data)
+
+class InlineDataTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(InlineDataTestCase, self).setUp()
+        self.repo_path = path.join(self.tmpdir, 'inline.sfs')
+        self.repo = GitStorage.create(self.repo_path, inline_max_size=100)
+
+    def reopen(self):
+        return GitStorage(self.repo_path).get_root()['f']
+
+    def test_small_file_is_inline(self):
+        f = self.repo.get_root().create_file('f')
+        f.write_data('tiny', 0)
+        self.repo.commit('tiny file')
+        self.assertEqual(f.inode.tree.keys(), ['data'])
+        self.assertEqual(self.reopen()._read_all_data(), 'tiny')
+
+    def test_promote_and_demote(self):
+        f = self.repo.get_root().create_file('f')
+        f.write_data('tiny', 0)
+        self.repo.commit('tiny file')
+        data = randomdata(70 * 1024)
+        f.write_data(data, 4)
+        self.repo.commit('grown file')
+        self.assertFalse('data' in f.inode.tree.keys())
+        self.assertEqual(self.reopen()._read_all_data(), 'tiny' + data)
+
+        f.truncate(10)
+        self.repo.commit('shrunk file')
+        self.assertEqual(f.inode.tree.keys(), ['data'])
+        self.assertEqual(self.reopen()._read_all_data(), 'tiny' + data[:6])
+
+        f.truncate(0)
+        self.repo.commit('empty file')
+        self.assertEqual(f.inode.tree.keys(), [])
+        self.assertEqual(self.reopen()._read_all_data(), '')
+        out = StringIO()
+        self.assertEqual(storage.fsck(self.repo_path, out), 0)
+
+    def test_limited_to_one_block(self):
+        repo_path = path.join(self.tmpdir, 'small.sfs')
+        repo = GitStorage.create(repo_path, default_blocksize=1024)
+        self.assertEqual(repo.inline_max_size, 1024)
+        # repositories made before the limit was enforced
+        repo.inline_max_size = 4096
+        f = repo.get_root().create_file('f')
+        data = randomdata(3000)
+        f.write_data(data, 0)
+        repo.commit('3 blocks')
+        self.assertFalse('data' in f.inode.tree.keys())
+        f.truncate(1000)
+        repo.commit('1 block')
+        self.assertEqual(f.inode.tree.keys(), ['data'])
+        f_2 = GitStorage(repo_path).get_root()['f']
+        self.assertEqual(f_2._read_all_data(), data[:1000])
+        self.assertEqual(storage.fsck(repo_path, StringIO()), 0)
+
+    def test_disabled_for_old_repos(self):
+        repo = GitStorage(path.join(self.tmpdir, 'repo.sfs'))
+        f = repo.get_root().create_file('f')
+        f.write_data('tiny', 0)
+        repo.commit('tiny file')
+        self.assertTrue('bt1' in f.inode.tree.keys())
+
+class ChunkedInodeTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(ChunkedInodeTestCase, self).setUp()
+        self.repo_path = path.join(self.tmpdir, 'chunked.sfs')
+        self.repo = GitStorage.create(self.repo_path, file_layout='chunked')
+        self.repo.autocommit = False
+
+    def chunk_blobs(self, inode):
+        inode._load_index()
+        return set(inode.tt[str(chunk_id)].git_id
+                   for chunk_id in inode._chunk_ids)
+
+    def test_chunker(self):
+        chunker = storage.Chunker(min_size=64, mask_bits=6, max_size=1024)
+        data = randomdata(64 * 1024)
+        cuts = chunker.split(data)
+        self.assertEqual(cuts[-1], len(data))
+        sizes = [b - a for a, b in zip([0] + cuts, cuts)]
+        self.assertTrue(all(64 <= size <= 1024 for size in sizes[:-1]))
+        # boundaries resynchronize after an insertion
+        shifted = chunker.split('x' + data)
+        self.assertTrue(len(set(c + 1 for c in cuts) & set(shifted)) >
+                        len(cuts) * 0.9)
+
+    def test_read_write(self):
+        f = self.repo.get_root().create_file('f')
+        self.assertTrue(isinstance(f.inode, storage.ChunkedInode))
+        data = randomdata(300 * 1024)
+        for offset in range(0, len(data), 4096):
+            f.write_data(data[offset:offset + 4096], offset)
+        self.assertEqual(f.read_data(1000, 100000), data[1000:101000])
+        self.repo.commit('chunked file')
+        f.write_data('hello', 200 * 1024)
+        data = data[:200 * 1024] + 'hello' + data[200 * 1024 + 5:]
+        self.assertEqual(f._read_all_data(), data)
+        f.truncate(150 * 1024)
+        f.truncate(160 * 1024)
+        data = data[:150 * 1024] + '\0' * 10 * 1024
+        self.repo.commit('edited')
+
+        f_2 = GitStorage(self.repo_path).get_root()['f']
+        self.assertEqual(f_2._read_all_data(), data)
+        out = StringIO()
+        self.assertEqual(storage.fsck(self.repo_path, out), 0)
+
+    def test_insertion_reuses_chunks(self):
+        data = randomdata(1024 * 1024)
+        f = self.repo.get_root().create_file('f')
+        f.write_data(data, 0)
+        self.repo.commit('original')
+        before = self.chunk_blobs(f.inode)
+        self.assertTrue(len(before) > 4)
+
+        g = self.repo.get_root().create_file('g')
+        g.write_data(data[:500000] + 'inserted' + data[500000:], 0)
+        self.repo.commit('edited copy')
+        after = self.chunk_blobs(g.inode)
+        self.assertTrue(len(after - before) <= 2)
+
+class FsckTestCase(SpaghettiTestCase):
+    def run_fsck(self):
+        out = StringIO()
+        problems = storage.fsck(self.repo_path, out, processes=2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), problems + 1)
+        return lines[:-1]
+
+    def test_clean(self):
+        b = self.repo.get_root()['b']
+        f = b.create_file('f')
+        f.write_data('x' * 100 * 1024, 0)
+        b.link_file('g', f)
+        b.create_directory('h').create_file('i')
+        self.assertEqual(self.run_fsck(), [])
+
+    def test_problems(self):
+        root = self.repo.get_root()
+        with root.listing.container['root.ls'] as ls:
+            ls.data += 'ghost i9\nbad x\n'
+        root['b']['c']['d.txt'].inode['nlink'] = 3
+        root['b']['f.txt'].inode['size'] = 2
+        root['b'].remove_ls_entry('f.txt')
+        storage.fsck_chunk_size = 2
+        try:
+            self.assertEqual(sorted(self.run_fsck()), [
+                "/bad: bad inode name 'x'",
+                "/ghost: inode 'i9' is past next_inode_number",
+                "i2: nlink is 3, but it is referenced 1 times",
+                "i4: orphaned inode, not referenced by any directory",
+                "i4: size is 2, but block 0 ends at 10",
+            ])
+        finally:
+            storage.fsck_chunk_size = 10000
+
 class InodeMetaTestCase(SpaghettiTestCase):
     def test_read(self):
         a = self.repo.get_root()['a.txt']
@@ -373,6 +829,104 @@ class InodeMetaTestCase(SpaghettiTestCase):
         self.assertEqual(a_2.inode['mode'], 0100755)
         self.assertEqual(a_2.inode['uid'], 1000)
 
+    def test_parsed_once_written_on_commit(self):
+        self.repo.autocommit = False
+        a = self.repo.get_root()['a.txt']
+        reads = []
+        read_meta = a.inode._read_meta
+        a.inode._read_meta = lambda: reads.append(1) or read_meta()
+        meta_blob_id = a.inode.tree['meta'].git_id
+
+        for c in range(10):
+            a.inode['size'] = a.inode['size'] + 1
+            a.inode['nlink']
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(a.inode.tree['meta'].git_id, meta_blob_id)
+
+        self.repo.commit('change meta')
+        self.assertEqual(len(reads), 1)
+        self.assertNotEqual(a.inode.tree['meta'].git_id, meta_blob_id)
+        repo2 = GitStorage(self.repo_path)
+        self.assertEqual(repo2.get_root()['a.txt'].inode['size'], 24)
+
+    def test_timestamps(self):
+        a = self.repo.get_root()['a.txt']
+        self.assertEqual(a.inode['mtime'], 0) # written before timestamps
+
+        a.inode.touch()
+        mtime = a.inode['mtime']
+        self.assertTrue(mtime > 0)
+        self.assertEqual(a.inode['ctime'], mtime)
+        a.inode['mtime'] = mtime - 100
+        self.repo.get_root()['b'].link_file('a_link', a)
+        self.assertEqual(a.inode['mtime'], mtime - 100)
+        self.assertTrue(a.inode['ctime'] >= mtime)
+
+        f = self.repo.get_root().create_file('new')
+        self.assertTrue(f.inode['mtime'] >= mtime)
+
+        repo2 = GitStorage(self.repo_path)
+        a_2 = repo2.get_root()['a.txt']
+        self.assertEqual(a_2.inode['mtime'], mtime - 100)
+
+class InodeMetaTableTestCase(SpaghettiTestCase):
+    def setUp(self):
+        super(InodeMetaTableTestCase, self).setUp()
+        self.repo_path = path.join(self.tmpdir, 'table.sfs')
+        self.repo = GitStorage.create(self.repo_path)
+
+    def test_metadata_in_table(self):
+        f = self.repo.get_root().create_file('f')
+        f.write_data('hello', 0)
+        f.inode['mode'] = 0100755
+        self.repo.commit('write file')
+        self.assertFalse('meta' in f.inode.tree)
+
+        repo2 = GitStorage(self.repo_path)
+        inode_2 = repo2.get_root()['f'].inode
+        self.assertEqual(inode_2['size'], 5)
+        self.assertEqual(inode_2['mode'], 0100755)
+        self.assertEqual(inode_2['nlink'], 1)
+        self.assertTrue(inode_2['mtime'] > 0)
+        self.assertEqual(repo2.meta_table.get(1)['size'], 5)
+        self.assertEqual(len(repo2.eg.root['inode_meta']['mt1']['0'].data),
+                         2 * storage.InodeMetaTable.record.size)
+
+    def test_unlink_clears_record(self):
+        f = self.repo.get_root().create_file('f')
+        f.write_data('hello', 0)
+        self.repo.commit('write file')
+        self.assertTrue(self.repo.meta_table.get(1) is not None)
+        f.unlink()
+        self.assertTrue(self.repo.meta_table.get(1) is None)
+        self.assertFalse('mt1' in self.repo.eg.root['inode_meta'])
+
+    def test_fsck(self):
+        root = self.repo.get_root()
+        root.create_file('f').write_data('hello', 0)
+        root.create_file('g')
+        self.repo.commit('two files')
+        out = StringIO()
+        self.assertEqual(storage.fsck(self.repo_path, out), 0)
+
+class InodeMetaTableUpgradeTestCase(SpaghettiTestCase):
+    def test_upgrade(self):
+        self.repo.get_root()['a.txt'].inode['uid'] = 1000
+        storage.convert_fs_to_meta_table(self.repo_path)
+
+        repo2 = GitStorage(self.repo_path)
+        self.assertTrue(repo2.meta_table is not None)
+        a = repo2.get_root()['a.txt']
+        self.assertFalse('meta' in a.inode.tree)
+        self.assertEqual(a.inode['uid'], 1000)
+        self.assertEqual(a.inode['mode'], 0100644)
+        self.assertEqual(a._read_all_data(), 'text file "a"\n')
+        f = repo2.get_root()['b']['f.txt']
+        self.assertEqual(f._read_all_data(), 'F is here\n')
+
+        out = StringIO()
+        self.assertEqual(storage.fsck(self.repo_path, out), 0)
+
 class GitStructureTestCase(SpaghettiTestCase):
     def test_commit_chain(self):
         def assert_head_ancestor(repo, ancestor_id):
@@ -400,6 +954,124 @@ class GitStructureTestCase(SpaghettiTestCase):
         repo = dulwich.repo.Repo(self.repo_path)
         assert_head_ancestor(repo, HEAD_1)
 
+class GroupCommitTestCase(SpaghettiTestCase):
+    def head(self):
+        return dulwich.repo.Repo(self.repo_path).head()
+
+    def test_one_commit_per_operation(self):
+        root = self.repo.get_root()
+        head_0 = self.head()
+        root['b'].link_file('linked_a.txt', root['a.txt'])
+        head_1 = self.head()
+        git = dulwich.repo.Repo(self.repo_path)
+        self.assertEqual(git.commit(head_1).parents, [head_0])
+
+    def test_operation_count(self):
+        self.repo.autocommit = CommitPolicy(max_operations=3)
+        b = self.repo.get_root()['b']
+        head_0 = self.head()
+        b.create_file('f1')
+        b.create_file('f2')
+        self.assertEqual(self.head(), head_0)
+        b.create_file('f3')
+        self.assertNotEqual(self.head(), head_0)
+
+        repo2 = GitStorage(self.repo_path)
+        self.assertEqual(set(repo2.get_root()['b'].keys()),
+                         set(['c', 'f.txt', 'f1', 'f2', 'f3']))
+
+    def test_bytes_written(self):
+        self.repo.autocommit = CommitPolicy(max_operations=None,
+                                            max_bytes=1000)
+        f = self.repo.get_root()['b'].create_file('f')
+        head_0 = self.head()
+        f.write_data('x' * 600, 0)
+        self.assertEqual(self.head(), head_0)
+        f.write_data('x' * 600, 600)
+        self.assertNotEqual(self.head(), head_0)
+
+    def test_delay(self):
+        policy = CommitPolicy(max_operations=None, max_delay=60)
+        self.repo.autocommit = policy
+        b = self.repo.get_root()['b']
+        head_0 = self.head()
+        b.create_file('f1')
+        self.assertEqual(self.head(), head_0)
+        policy.first_change -= 61
+        b.create_file('f2')
+        self.assertNotEqual(self.head(), head_0)
+
+    def test_idle_delay_needs_sync(self):
+        policy = CommitPolicy(max_operations=None, max_delay=60)
+        self.repo.autocommit = policy
+        head_0 = self.head()
+        self.repo.get_root()['b'].create_file('f1')
+        policy.first_change -= 61
+        # nothing checks the delay until the next operation
+        self.assertEqual(self.head(), head_0)
+        self.repo.sync()
+        self.assertNotEqual(self.head(), head_0)
+
+    def test_sync(self):
+        self.repo.autocommit = CommitPolicy(max_operations=None)
+        head_0 = self.head()
+        self.repo.sync()
+        self.assertEqual(self.head(), head_0)
+        self.repo.get_root()['b'].create_file('f')
+        self.assertEqual(self.head(), head_0)
+        self.repo.sync()
+        self.assertNotEqual(self.head(), head_0)
+
+        repo2 = GitStorage(self.repo_path)
+        self.assertTrue('f' in repo2.get_root()['b'])
+
+    def test_snapshot_then_write(self):
+        self.repo.autocommit = False
+        root = self.repo.get_root()
+        head_0 = self.head()
+        root['a.txt'].write_data('snapshotted', 0)
+        tree_id = self.repo.snapshot()
+        root['b'].create_file('later')
+        self.repo.write_commit(tree_id, 'first half')
+
+        git = dulwich.repo.Repo(self.repo_path)
+        self.assertEqual(git.commit(self.head()).tree, tree_id)
+        repo2 = GitStorage(self.repo_path)
+        self.assertEqual(repo2.get_root()['a.txt'].read_data(0, 11),
+                         'snapshotted')
+        self.assertFalse('later' in repo2.get_root()['b'])
+
+        self.repo.commit('second half')
+        repo3 = GitStorage(self.repo_path)
+        self.assertTrue('later' in repo3.get_root()['b'])
+
+class NoopCommitTestCase(SpaghettiTestCase):
+    def head(self):
+        return dulwich.repo.Repo(self.repo_path).head()
+
+    def test_unchanged_tree_is_not_committed(self):
+        self.repo.autocommit = False
+        head_0 = self.head()
+        object_store = self.repo.eg.git.object_store
+        root = self.repo.get_root()
+        root['b']['f.txt'].read_data(0, 100)
+        self.repo.commit('nothing')
+        self.repo.commit(amend=True)
+        self.repo.commit('Created empty filesystem', amend=True)
+        self.assertEqual(self.head(), head_0)
+        self.assertEqual(object_store.objects_written, 0)
+
+        self.repo.commit('new message', amend=True)
+        self.assertNotEqual(self.head(), head_0)
+
+    def test_other_branch_is_committed(self):
+        self.repo.autocommit = False
+        head_0 = self.head()
+        self.repo.commit('branched', branch='other', head_id=head_0)
+        git = dulwich.repo.Repo(self.repo_path)
+        other_id = git.refs['refs/heads/other']
+        self.assertEqual(git.commit(other_id).parents, [head_0])
+
 class RepoInitTestCase(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp()